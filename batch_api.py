@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import hashlib
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def document_id(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+
+class BatchClient:
+    """
+    Runs one stage of rendered prompts through an OpenAI-compatible batch endpoint:
+    write a JSONL request file, upload it, create the batch, poll until it finishes and join the answers by custom_id.
+    Submitted batch ids are kept in work_dir, so a restarted job resumes polling instead of paying again.
+    """
+    def __init__(self, model="deepseek-chat", base_url=None, api_key=None, max_tokens=4096, work_dir=".cache/batches",
+                 poll_interval=30.0, max_requests_per_batch=50000, completion_window="24h"):
+        import openai
+        self.client = openai.OpenAI(
+            base_url=base_url or os.getenv("BATCH_API_BASE", "https://api.deepseek.com"),
+            api_key=api_key or os.getenv("BATCH_API_KEY") or os.getenv("DEEPSEEK_API_KEY") or "local"
+        )
+        self.model = model
+        self.max_tokens = max_tokens
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.max_requests_per_batch = max_requests_per_batch
+        self.completion_window = completion_window
+        os.makedirs(work_dir, exist_ok=True)
+
+    def request_line(self, custom_id, prompt):
+        body = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "max_tokens": self.max_tokens}
+        return json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}, ensure_ascii=False)
+
+    def run_stage(self, name, prompts, metrics=None):
+        """
+        prompts maps custom_id to the rendered prompt. Returns custom_id -> completion text,
+        without the ids whose request failed. With a MetricsRecorder, the requests and failed requests
+        are counted as batch_requests and batch_failed_requests, the reported usage goes to the token and cost
+        counters of stage name, and the time until the last part finished to its latency histogram.
+        """
+        start_time = time.perf_counter()
+        items = list(prompts.items())
+        results = {}
+        for part, start in enumerate(range(0, len(items), self.max_requests_per_batch)):
+            output = self._run_part(f"{name}-{part:04d}", items[start:start + self.max_requests_per_batch])
+            results.update(self.parse_output(output, name, metrics))
+        if metrics and items:
+            metrics.observe_latency(name, time.perf_counter() - start_time)
+            metrics.increment("batch_requests", len(prompts))
+            metrics.increment("batch_failed_requests", len(prompts) - len(results))
+        return results
+
+    def _run_part(self, name, items):
+        request_path = os.path.join(self.work_dir, f"{name}.requests.jsonl")
+        state_path = os.path.join(self.work_dir, f"{name}.state.json")
+        content = "".join(self.request_line(custom_id, prompt) + "\n" for custom_id, prompt in items)
+        request_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+        if state.get("request_hash") != request_hash or state.get("status") in {"failed", "expired", "cancelled"}:
+            with open(request_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            with open(request_path, "rb") as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window=self.completion_window)
+            state = {"request_hash": request_hash, "batch_id": batch.id, "status": batch.status}
+            self._save_state(state_path, state)
+
+        batch = self.client.batches.retrieve(state["batch_id"])
+        while batch.status not in TERMINAL_STATUSES:
+            time.sleep(self.poll_interval)
+            batch = self.client.batches.retrieve(state["batch_id"])
+        state["status"] = batch.status
+        self._save_state(state_path, state)
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"Batch {batch.id} for stage {name} ended with status {batch.status}")
+
+        output = self.client.files.content(batch.output_file_id).text
+        with open(os.path.join(self.work_dir, f"{name}.output.jsonl"), "w", encoding="utf-8") as f:
+            f.write(output)
+        return output
+
+    def parse_output(self, output, stage=None, metrics=None):
+        results = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if entry.get("error") or response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            results[entry["custom_id"]] = body["choices"][0]["message"]["content"]
+            usage = body.get("usage")
+            if metrics and usage:
+                # DeepSeek reports prefix cache hits as prompt_cache_hit_tokens, OpenAI under prompt_tokens_details.
+                cached_tokens = usage.get("prompt_cache_hit_tokens") or (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+                metrics.add_tokens(stage, body.get("model") or self.model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), cached_tokens)
+        return results
+
+    def _save_state(self, state_path, state):
+        with open(state_path, "w") as f:
+            json.dump(state, f)
@@ -0,0 +1,174 @@
+"""
+Local stand-in for the OpenAI-compatible file upload and batch endpoints, answering with the deterministic fake model.
+
+    python batch_server.py --port 8089 --processing-delay 2
+    BATCH_API_BASE=http://127.0.0.1:8089/v1 python genre_transformation/summary/all.py
+
+Implements POST /v1/files, GET /v1/files/{id}, GET /v1/files/{id}/content, POST /v1/batches,
+GET /v1/batches/{id} and POST /v1/batches/{id}/cancel.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from fake_llm import fake_completion, prompt_rng
+
+
+class BatchStore:
+    def __init__(self, processing_delay=0.0, error_rate=0.0, seed=0):
+        self.files = {}
+        self.batches = {}
+        self.processing_delay = processing_delay
+        self.error_rate = error_rate
+        self.seed = seed
+        self.lock = threading.Lock()
+
+    def add_file(self, content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = {
+                "meta": {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                         "filename": filename, "purpose": purpose, "status": "processed"},
+                "content": content,
+            }
+        return self.files[file_id]["meta"]
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        now = int(time.time())
+        batch = {"id": batch_id, "object": "batch", "endpoint": endpoint, "errors": None, "input_file_id": input_file_id,
+                 "completion_window": completion_window, "status": "validating", "output_file_id": None, "error_file_id": None,
+                 "created_at": now, "in_progress_at": None, "expires_at": now + 86400, "finalizing_at": None, "completed_at": None,
+                 "failed_at": None, "expired_at": None, "cancelling_at": None, "cancelled_at": None,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": None}
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self.process, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def process(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        batch.update(status="in_progress", in_progress_at=int(time.time()))
+        batch["request_counts"]["total"] = len(lines)
+        time.sleep(self.processing_delay)
+
+        outputs = []
+        for line in lines:
+            if batch["status"] == "cancelling":
+                batch.update(status="cancelled", cancelled_at=int(time.time()))
+                return
+            request = json.loads(line)
+            prompt = "\n".join(message["content"] for message in request["body"]["messages"])
+            rng = prompt_rng(prompt, self.seed)
+            if rng.random() < self.error_rate:
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                                "response": {"status_code": 500, "request_id": uuid.uuid4().hex, "body": {"error": {"message": "Injected failure"}}}, "error": None})
+                batch["request_counts"]["failed"] += 1
+                continue
+            text = fake_completion(prompt, rng, min(200, request["body"].get("max_tokens", 200)))
+            usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(text.split())}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            body = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}], "usage": usage}
+            outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                            "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body}, "error": None})
+            batch["request_counts"]["completed"] += 1
+
+        batch.update(status="finalizing", finalizing_at=int(time.time()))
+        content = "".join(json.dumps(output) + "\n" for output in outputs).encode("utf-8")
+        output_file = self.add_file(content, f"{batch_id}_output.jsonl", "batch_output")
+        batch.update(status="completed", output_file_id=output_file["id"], completed_at=int(time.time()))
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    store = None
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        self.send_json({"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}}, 404)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        parts = self.path.rstrip("/").split("/")
+        if self.path.rstrip("/") == "/v1/files":
+            # Multipart upload: parse it as a MIME message.
+            header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+            message = BytesParser(policy=HTTP).parsebytes(header + self.read_body())
+            fields, content, filename = {}, b"", "upload.jsonl"
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if name == "file":
+                    content = part.get_payload(decode=True)
+                    filename = part.get_filename() or filename
+                else:
+                    fields[name] = part.get_payload(decode=True).decode("utf-8")
+            self.send_json(self.store.add_file(content, filename, fields.get("purpose", "batch")))
+        elif self.path.rstrip("/") == "/v1/batches":
+            request = json.loads(self.read_body() or b"{}")
+            if request.get("input_file_id") not in self.store.files:
+                self.send_json({"error": {"message": "Unknown input_file_id", "type": "invalid_request_error"}}, 400)
+                return
+            self.send_json(self.store.create_batch(request["input_file_id"], request.get("endpoint"), request.get("completion_window", "24h")))
+        elif len(parts) == 5 and parts[2] == "batches" and parts[4] == "cancel" and parts[3] in self.store.batches:
+            batch = self.store.batches[parts[3]]
+            if batch["status"] not in {"completed", "failed", "expired", "cancelled"}:
+                batch.update(status="cancelling", cancelling_at=int(time.time()))
+            self.send_json(batch)
+        else:
+            self.not_found()
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if len(parts) == 4 and parts[2] == "batches" and parts[3] in self.store.batches:
+            self.send_json(self.store.batches[parts[3]])
+        elif len(parts) == 4 and parts[2] == "files" and parts[3] in self.store.files:
+            self.send_json(self.store.files[parts[3]]["meta"])
+        elif len(parts) == 5 and parts[2] == "files" and parts[4] == "content" and parts[3] in self.store.files:
+            content = self.store.files[parts[3]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.not_found()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host="127.0.0.1", port=8089, processing_delay=0.0, error_rate=0.0):
+    BatchHandler.store = BatchStore(processing_delay, error_rate)
+    server = ThreadingHTTPServer((host, port), BatchHandler)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--processing-delay", type=float, default=0.0, help="seconds each batch stays in_progress")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with status 500")
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.processing_delay, args.error_rate)
+    print(f"Batch stand-in listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
@@ -0,0 +1,303 @@
+"""
+Offline end-to-end throughput benchmark on the fake LLM backend.
+
+    python benchmark.py --docs 200 --latency 0.05 --scenarios narration,narration_async,narration_pipeline,summary,quiz
+    python benchmark.py --docs 50 --token-latency 0.001 --scenarios narration,narration_stream
+
+Each scenario runs in its own process so peak RSS is measured per scenario.
+
+    python benchmark.py --startup --import-budget 1.5
+
+measures the import time of every entry point in a fresh interpreter instead, failing when one exceeds the budget.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import resource
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+WORDS = ("the of and to in is that for as with was on by are this be from at an which or it its has have not "
+         "chapter function value system language history method example theory data process model table "
+         "energy cell market design network program sentence river language king empire protein equation").split()
+
+
+def synthetic_corpus(n, seed=0, min_words=150, max_words=1500):
+    from langchain_core.documents import Document
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        title = f"Book {i}/Chapter {rng.randint(1, 30)}"
+        body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+        corpus.append(Document(page_content=f"{title}\n{body}.", metadata={"seq_num": i}))
+    return corpus
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def time_method(obj, name, latencies):
+    """
+    Replace obj.name with a wrapper appending the wall time of every call to latencies.
+    """
+    method = getattr(obj, name)
+    if asyncio.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+    else:
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+    setattr(obj, name, timed)
+
+
+def run_chunks(docs, chunk_size, run):
+    """
+    Run docs in chunks so an injected error only loses its own chunk. Returns (records, errors).
+    """
+    records, errors = 0, 0
+    for start in range(0, len(docs), chunk_size):
+        chunk = docs[start:start + chunk_size]
+        try:
+            records += len(run(chunk))
+        except Exception:
+            errors += len(chunk)
+    return records, errors
+
+
+def bench_narration(docs, args, latencies, prompt_layout="text_first", streaming=False):
+    from genre_transformation.narration.all import NarrativeTransformer
+
+    transformer = NarrativeTransformer(max_concurrency=args.concurrency, prompt_layout=prompt_layout, streaming=streaming)
+    time_method(transformer, "transform_document", latencies)
+    return run_chunks(docs, args.chunk, lambda chunk: list(transformer.iter_transform(chunk))), transformer.metrics
+
+
+def bench_narration_async(docs, args, latencies):
+    from genre_transformation.narration.all import NarrativeTransformer
+
+    transformer = NarrativeTransformer(max_concurrency=args.concurrency)
+    time_method(transformer, "atransform_document", latencies)
+    return run_chunks(docs, args.chunk * args.concurrency, lambda chunk: asyncio.run(transformer.atransform_dataset(chunk))), transformer.metrics
+
+
+class ListWriter(list):
+    write = list.append
+
+
+def bench_narration_pipeline(docs, args, latencies):
+    from genre_transformation.narration.all import NarrativeTransformer
+
+    # Stages overlap across documents, so no per-document latency is recorded for this scenario.
+    transformer = NarrativeTransformer(max_concurrency=args.concurrency)
+    writer = ListWriter()
+    asyncio.run(transformer.apipeline_dataset(docs, writer))
+    errors = sum(value for name, value in transformer.metrics.summary()["counters"].items() if name.startswith("pipeline_"))
+    return (len(writer), errors), transformer.metrics
+
+
+def bench_summary(docs, args, latencies, combined=False, prompt_layout="text_first", streaming=False):
+    from genre_transformation.summary.all import SummaryTransformer
+
+    transformer = SummaryTransformer(combined=combined, prompt_layout=prompt_layout, streaming=streaming)
+    time_method(transformer, "summarize", latencies)
+    return run_chunks(docs, args.chunk, lambda chunk: list(transformer.iter_transform(chunk))), transformer.metrics
+
+
+def bench_quiz(docs, args, latencies):
+    from mcq_generation import quiz
+
+    quiz.configure_dspy("fake")
+    quiz_generator = quiz.build_quiz_generator()
+    rng = random.Random(args.seed)
+    examples = [(f"What is {doc.page_content.split(chr(10))[0]} about?", rng.choice(WORDS)) for doc in docs]
+
+    def generate(example):
+        start = time.perf_counter()
+        try:
+            quiz_generator(question=example[0], answer=example[1])
+            return True
+        except Exception:
+            return False
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(generate, examples))
+    return (sum(results), len(results) - sum(results)), None
+
+
+SCENARIOS = {
+    "narration": bench_narration,
+    "narration_async": bench_narration_async,
+    "narration_pipeline": bench_narration_pipeline,
+    "summary": bench_summary,
+    "summary_combined": functools.partial(bench_summary, combined=True),
+    # Prompt layout A/B: same work with a fixed preamble before the document, see prompt_cache_hit_ratio.
+    "narration_prefix": functools.partial(bench_narration, prompt_layout="shared_prefix"),
+    "summary_prefix": functools.partial(bench_summary, prompt_layout="shared_prefix"),
+    # Streamed generation with early stop conditions, see the ttft column and the *_early_stop_* counters.
+    "narration_stream": functools.partial(bench_narration, streaming=True),
+    "summary_stream": functools.partial(bench_summary, streaming=True),
+    "quiz": bench_quiz,
+}
+
+
+STARTUP_MODULES = [
+    "llm_api",
+    "genre_transformation.narration.all",
+    "genre_transformation.summary.all",
+    "genre_transformation.summary.overall",
+    "genre_transformation.summary.different_perspective",
+    "genre_transformation.augmentation.augmentation",
+    "mcq_generation.quiz",
+    "run_sharded",
+]
+
+
+def import_seconds(module, repeats=3):
+    """
+    Best-of-repeats wall time of importing module in a fresh interpreter.
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    root = os.path.abspath(os.path.dirname(__file__))
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return min(times)
+
+
+def run_startup(args):
+    results, over_budget = [], []
+    print(f"{'module':<52}{'import (s)':>12}")
+    for module in STARTUP_MODULES:
+        try:
+            seconds = import_seconds(module, args.repeats)
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<52}{'failed':>12}  {e.stderr.strip().splitlines()[-1] if e.stderr.strip() else ''}")
+            over_budget.append(module)
+            continue
+        results.append({"module": module, "import_seconds": seconds})
+        print(f"{module:<52}{seconds:>12.3f}")
+        if args.import_budget and seconds > args.import_budget:
+            over_budget.append(module)
+    if over_budget:
+        reason = f"Failed or over the {args.import_budget}s import budget" if args.import_budget else "Failed to import"
+        print(f"{reason}: {', '.join(over_budget)}", file=sys.stderr)
+    return results, not over_budget
+
+
+def mean_ttft(metrics):
+    """
+    Mean time to first token over every streamed stage, 0.0 for scenarios that do not stream.
+    """
+    histograms = [histogram for stage, histogram in metrics.summary()["latency_seconds"].items() if stage.endswith("_ttft")] if metrics else []
+    count = sum(histogram["count"] for histogram in histograms)
+    return sum(histogram["sum"] for histogram in histograms) / count if count else 0.0
+
+
+def run_scenario(name, args, queue):
+    os.environ.update({
+        "LLM_MODEL": "fake",
+        "FAKE_LLM_LATENCY": str(args.latency),
+        "FAKE_LLM_LATENCY_STD": str(args.latency_std),
+        "FAKE_LLM_ERROR_RATE": str(args.error_rate),
+        "FAKE_LLM_TOKEN_LATENCY": str(args.token_latency),
+        "FAKE_LLM_CACHE_PATH": args.cache or "",
+    })
+    latencies = []
+    metrics = None
+    start = time.perf_counter()
+    try:
+        docs = synthetic_corpus(args.docs, seed=args.seed)
+        start = time.perf_counter()
+        (records, errors), metrics = SCENARIOS[name](docs, args, latencies)
+    except Exception as e:
+        print(f"Scenario {name} failed: {e!r}", file=sys.stderr)
+        records, errors = 0, args.docs
+    elapsed = time.perf_counter() - start
+    queue.put({
+        "scenario": name,
+        "docs": args.docs,
+        "records": records,
+        "errors": errors,
+        "seconds": elapsed,
+        "docs_per_sec": args.docs / elapsed if elapsed else 0.0,
+        "p50_latency": percentile(latencies, 50),
+        "p99_latency": percentile(latencies, 99),
+        "prompt_cache_hit_ratio": metrics.summary()["prompt_cache_hit_ratio"] if metrics else 0.0,
+        "mean_ttft": mean_ttft(metrics),
+        # ru_maxrss is reported in kilobytes on Linux.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--docs", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean fake LLM latency in seconds")
+    parser.add_argument("--latency-std", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0, help="fake LLM seconds per streamed word after the first")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chunk", type=int, default=8, help="documents per chunk; an injected error drops its chunk")
+    parser.add_argument("--cache", default=None, help="LLM cache database path for the fake model (off by default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write the results as JSON to this path")
+    parser.add_argument("--startup", action="store_true", help="measure entry point import times instead of throughput")
+    parser.add_argument("--import-budget", type=float, default=None, help="seconds allowed per entry point import with --startup")
+    parser.add_argument("--repeats", type=int, default=3, help="fresh interpreters per entry point with --startup")
+    args = parser.parse_args()
+
+    if args.startup:
+        results, within_budget = run_startup(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+        sys.exit(0 if within_budget else 1)
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in args.scenarios.split(","):
+        queue = context.Queue()
+        process = context.Process(target=run_scenario, args=(name, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+
+    print(f"{'scenario':<18}{'docs/s':>10}{'p50 (s)':>10}{'p99 (s)':>10}{'records':>9}{'errors':>8}{'RSS (MB)':>10}{'cache hit':>11}{'ttft (s)':>10}")
+    for result in results:
+        print(f"{result['scenario']:<18}{result['docs_per_sec']:>10.2f}{result['p50_latency']:>10.3f}{result['p99_latency']:>10.3f}"
+              f"{result['records']:>9}{result['errors']:>8}{result['peak_rss_mb']:>10.1f}{result['prompt_cache_hit_ratio']:>11.1%}{result['mean_ttft']:>10.3f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
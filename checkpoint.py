@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+
+
+def prompt_version(*prompts):
+    """
+    Short hash of the prompt templates, so editing a prompt invalidates earlier checkpoints.
+    """
+    digest = hashlib.sha256()
+    for prompt in prompts:
+        digest.update(getattr(prompt, "template", str(prompt)).encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def add_counts(state, delta):
+    """
+    state plus delta, for nested dicts of counts.
+    """
+    merged = dict(state)
+    for key, value in delta.items():
+        merged[key] = add_counts(merged.get(key) or {}, value) if isinstance(value, dict) else merged.get(key, 0) + value
+    return merged
+
+
+class CheckpointStore:
+    """
+    Append-only record of finished documents, keyed by a hash of page_content, transformer type and prompt version.
+    Each entry may carry a state snapshot or a delta of counts; a resumed run restores the latest snapshot plus
+    every delta recorded after it.
+    """
+    def __init__(self, save_path, transformer_type, prompt_version):
+        self.save_path = save_path
+        self.transformer_type = transformer_type
+        self.prompt_version = prompt_version
+        self.done = set()
+        self.state = None
+
+        if os.path.exists(save_path):
+            with open(save_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from a crash
+                    if entry.get("transformer_type") != transformer_type or entry.get("prompt_version") != prompt_version:
+                        continue
+                    self.done.add(entry["key"])
+                    if entry.get("state") is not None:
+                        self.state = entry["state"]
+                    if entry.get("delta"):
+                        self.state = add_counts(self.state or {}, entry["delta"])
+
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        self.file = open(save_path, "a", encoding="utf-8")
+
+    def key(self, text):
+        content = f"{self.transformer_type}\0{self.prompt_version}\0{text}"
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def is_done(self, text):
+        return self.key(text) in self.done
+
+    def mark_done(self, text, state=None, delta=None):
+        """
+        state replaces the state to restore. delta is added to it instead, for runs that finish documents out of order,
+        where a snapshot would already include the updates of documents that are not done yet.
+        """
+        key = self.key(text)
+        self.done.add(key)
+        entry = {"key": key, "transformer_type": self.transformer_type, "prompt_version": self.prompt_version, "state": state}
+        if delta:
+            entry["delta"] = delta
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        if state is not None:
+            self.state = state
+        if delta:
+            self.state = add_counts(self.state or {}, delta)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,77 @@
+from langchain_core.prompts import PromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+
+
+class MapReduceCondenser:
+    """
+    Condense a long document so it fits into one prompt.
+    The text is split on token boundaries, every chunk is summarized in parallel (map),
+    and partial summaries are merged in parallel rounds (reduce) until the result fits in chunk_size tokens.
+    Short documents are returned unchanged without any LLM call.
+    chunk_overlap defaults to 200 tokens, at most a tenth of chunk_size.
+    """
+    def __init__(self, llm, chunk_size=3000, chunk_overlap=None, max_concurrency=8, encoding_name="cl100k_base", metrics=None):
+        if chunk_overlap is None:
+            chunk_overlap = min(200, chunk_size // 10)
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError(f"chunk_overlap must be at least 0 and smaller than chunk_size ({chunk_size} tokens), got {chunk_overlap}")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.max_concurrency = max_concurrency
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+        self.map_prompt = PromptTemplate.from_template("""{text}
+This is part {index} of {total} of a longer document. Summarize this part, keeping every main idea, key fact, name, number and definition it contains, so that the summaries of all parts together can replace the original document.""")
+
+        self.reduce_prompt = PromptTemplate.from_template("""{text}
+These are summaries of consecutive parts of one document. Merge them into a single coherent summary in the same order, keeping every main idea, key fact, name, number and definition, and removing repetition.""")
+
+        self.map_chain = self.map_prompt | llm | StrOutputParser()
+        self.reduce_chain = self.reduce_prompt | llm | StrOutputParser()
+        if metrics:
+            self.map_chain = self.map_chain.with_config(callbacks=[metrics.handler("chunk_map")])
+            self.reduce_chain = self.reduce_chain.with_config(callbacks=[metrics.handler("chunk_reduce")])
+
+    def count_tokens(self, text):
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def split(self, text):
+        tokens = self.encoding.encode(text, disallowed_special=())
+        step = self.chunk_size - self.chunk_overlap
+        return [self.encoding.decode(tokens[start:start + self.chunk_size]) for start in range(0, max(len(tokens) - self.chunk_overlap, 1), step)]
+
+    def group(self, summaries):
+        """
+        Pack consecutive summaries into groups of at most chunk_size tokens.
+        """
+        groups, current, current_tokens = [], [], 0
+        for summary in summaries:
+            tokens = self.count_tokens(summary)
+            if current and current_tokens + tokens > self.chunk_size:
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(summary)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    def condense(self, text):
+        if self.count_tokens(text) <= self.chunk_size:
+            return text
+
+        config = {"max_concurrency": self.max_concurrency}
+        chunks = self.split(text)
+        summaries = self.map_chain.batch([{"text": chunk, "index": i, "total": len(chunks)} for i, chunk in enumerate(chunks, start=1)], config=config)
+
+        while self.count_tokens("\n\n".join(summaries)) > self.chunk_size:
+            groups = self.group(summaries)
+            if len(groups) == len(summaries) and len(groups) > 1:
+                # Every summary fills a group on its own; pair them up so each round still shrinks the list.
+                groups = [sum(groups[i:i + 2], []) for i in range(0, len(groups), 2)]
+            summaries = self.reduce_chain.batch([{"text": "\n\n".join(group)} for group in groups], config=config)
+            if len(summaries) == 1:
+                break
+
+        return "\n\n".join(summaries)
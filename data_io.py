@@ -0,0 +1,97 @@
+import os
+import json
+import random
+from langchain_core.documents import Document
+
+
+def stream_documents(file_path, text_key="text", start=0, end=None):
+    """
+    Lazily read a JSONL corpus, yielding one Document per line.
+    Equivalent to JSONLoader(jq_schema='.text', json_lines=True) without loading the whole file.
+    start/end restrict reading to the lines beginning in the byte range [start, end), see shard_offsets.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        offset = start
+        seq_num = 0
+        while end is None or offset < end:
+            line = f.readline()
+            if not line:
+                break
+            line_offset, offset = offset, offset + len(line)
+            line = line.strip()
+            if not line:
+                continue
+            seq_num += 1
+            content = json.loads(line)[text_key]
+            if not isinstance(content, str):
+                content = json.dumps(content, ensure_ascii=False)
+            yield Document(page_content=content, metadata={"source": os.path.abspath(file_path), "seq_num": seq_num, "offset": line_offset})
+
+
+def shard_offsets(file_path, num_shards):
+    """
+    Split a JSONL file into num_shards deterministic byte ranges [(start, end), ...], each starting at a line boundary.
+    """
+    size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, num_shards):
+            f.seek(max(size * i // num_shards - 1, boundaries[-1]))
+            f.readline()  # Move to the start of the next line
+            boundaries.append(min(max(f.tell(), boundaries[-1]), size))
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def shuffle_buffer(iterable, buffer_size=10000, seed=None):
+    """
+    Approximately shuffle a stream while holding at most buffer_size items in memory.
+    Once the buffer is full, each incoming item replaces a random buffered item, which is emitted.
+    """
+    rng = random.Random(seed)
+    buffer = []
+    for item in iterable:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class JsonlWriter:
+    """
+    Append records to a JSONL file, flushing after every record so partial results survive a crash.
+    """
+    def __init__(self, save_path, mode="a"):
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        self.save_path = save_path
+        self.file = open(save_path, mode, encoding="utf-8")
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_jsonl(records, save_path, mode="a"):
+    """
+    Consume a record iterator, writing each record as soon as it is produced. Returns the number written.
+    """
+    count = 0
+    with JsonlWriter(save_path, mode) as writer:
+        for record in records:
+            writer.write(record)
+            count += 1
+    return count
@@ -0,0 +1,126 @@
+import re
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# About 2 KB of signature and band tables per stored document, so roughly 1 GB at this bound.
+DEFAULT_MAX_DOCUMENTS = 500_000
+
+
+def _integrate(f, a, b, steps=100):
+    width = (b - a) / steps
+    return sum(f(a + (i + 0.5) * width) for i in range(steps)) * width
+
+
+def optimal_bands(threshold, num_perm):
+    """
+    Pick (bands, rows) with bands * rows <= num_perm minimizing the sum of the false positive
+    and false negative areas of the LSH S-curve around threshold.
+    """
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        false_positive = _integrate(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+        false_negative = _integrate(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+        if false_positive + false_negative < best_error:
+            best, best_error = (bands, rows), false_positive + false_negative
+    return best
+
+
+class MinHashDeduplicator:
+    """
+    Streaming near-duplicate detection over page_content with MinHash signatures and LSH banding.
+    Only the signature of each kept document is stored, never its text; beyond max_documents the oldest
+    signatures are evicted, which bounds memory at the cost of missing duplicates further apart in the stream.
+    max_documents=None keeps every signature.
+    """
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=5, max_documents=DEFAULT_MAX_DOCUMENTS, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_documents = max_documents
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+        self.tables = [{} for _ in range(self.bands)]
+        self.signatures = OrderedDict()
+        self.seen = 0
+        self.duplicates = 0
+
+    def shingles(self, text):
+        words = re.findall(r"\w+", text.lower())
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter(
+            (int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in self.shingles(text)),
+            dtype=np.uint64
+        )
+        # Universal hashing (a * x + b) mod p for every permutation at once, one row per shingle.
+        permuted = np.bitwise_and((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME, MAX_HASH)
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def band_keys(self, signature):
+        return [hash(signature[i * self.rows:(i + 1) * self.rows].tobytes()) for i in range(self.bands)]
+
+    def query(self, signature, band_keys=None):
+        """
+        Return the key of a stored document whose estimated Jaccard similarity reaches threshold, or None.
+        """
+        candidates = set()
+        for table, band_key in zip(self.tables, band_keys or self.band_keys(signature)):
+            candidates.update(table.get(band_key, ()))
+        for key in candidates:
+            if np.mean(self.signatures[key][0] == signature) >= self.threshold:
+                return key
+        return None
+
+    def add(self, key, signature, band_keys=None):
+        band_keys = band_keys or self.band_keys(signature)
+        self.signatures[key] = (signature, band_keys)
+        for table, band_key in zip(self.tables, band_keys):
+            table.setdefault(band_key, []).append(key)
+        if self.max_documents and len(self.signatures) > self.max_documents:
+            self.remove(next(iter(self.signatures)))
+
+    def remove(self, key):
+        _, band_keys = self.signatures.pop(key)
+        for table, band_key in zip(self.tables, band_keys):
+            table[band_key].remove(key)
+            if not table[band_key]:
+                del table[band_key]
+
+    def check(self, text, key=None):
+        """
+        Return the key of the earlier near-duplicate of text, or None after remembering text as a new document.
+        """
+        self.seen += 1
+        key = key if key is not None else hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+        signature = self.signature(text)
+        band_keys = self.band_keys(signature)
+        duplicate_of = self.query(signature, band_keys)
+        if duplicate_of is not None:
+            self.duplicates += 1
+            return duplicate_of
+        self.add(key, signature, band_keys)
+        return None
+
+    def filter(self, dataset, drop=True):
+        """
+        Lazily deduplicate a stream of documents. With drop=False every document is kept and near-duplicates
+        are grouped instead, by setting metadata["duplicate_of"] to the key of the first document of their group.
+        """
+        for data in dataset:
+            duplicate_of = self.check(data.page_content)
+            if duplicate_of is None or not drop:
+                data.metadata["duplicate_of"] = duplicate_of
+                yield data
+
+    def stats(self):
+        return {"seen": self.seen, "duplicates": self.duplicates, "stored": len(self.signatures), "bands": self.bands, "rows": self.rows}
@@ -0,0 +1,51 @@
+import re
+import time
+import itertools
+import threading
+from dsp import LM
+from fake_llm import FakeLLMError, fake_completion, prompt_rng
+
+
+class FakeDSPyLM(LM):
+    """
+    The same deterministic fake for DSPy programs. Completions continue the last field prefix of the
+    DSPy prompt, e.g. "Reasoning: Let's think step by step in order to" or "Assessment Answer:".
+    """
+    def __init__(self, latency_mean=0.0, latency_std=0.0, error_rate=0.0, seed=0, **kwargs):
+        super().__init__(model="fake")
+        self.provider = "fake"
+        self.kwargs = {"temperature": 0.0, "max_tokens": 500, "n": 1, **kwargs}
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.error_rate = error_rate
+        self.seed = seed
+        self.calls = itertools.count()
+        self.lock = threading.Lock()
+
+    def completion(self, prompt, rng):
+        last_line = prompt.rstrip().splitlines()[-1] if prompt.strip() else ""
+        correct_answer = re.findall(r"^Correct Answer: (.*)$", prompt, re.MULTILINE)
+        correct_answer = correct_answer[-1].strip() if correct_answer else "answer"
+        choices = f'{{"A": "{correct_answer}", "B": "distractor {rng.randint(1, 99)}", "C": "distractor {rng.randint(100, 199)}", "D": "distractor {rng.randint(200, 299)}"}}'
+        if last_line.startswith("Reasoning:"):
+            return f" produce the answer choices. We keep the correct answer and add plausible distractors.\n\nAnswer Choices: {choices}"
+        if last_line.startswith("Answer Choices:"):
+            return f" {choices}"
+        if last_line.startswith("Assessment Answer:"):
+            return " Yes"
+        return " " + fake_completion(prompt, rng, 20)
+
+    def basic_request(self, prompt, **kwargs):
+        rng = prompt_rng(prompt, self.seed)
+        time.sleep(max(0.0, rng.gauss(self.latency_mean, self.latency_std)))
+        with self.lock:
+            call = next(self.calls)
+        if prompt_rng(f"{prompt}\0{call}", self.seed).random() < self.error_rate:
+            raise FakeLLMError("Injected fake LLM failure")
+        response = {"choices": [{"text": self.completion(prompt, rng), "finish_reason": "stop"} for _ in range(kwargs.get("n", 1))]}
+        self.history.append({"prompt": prompt, "response": response, "kwargs": kwargs})
+        return response
+
+    def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        response = self.basic_request(prompt, **{**self.kwargs, **kwargs})
+        return [choice["text"] for choice in response["choices"]]
@@ -0,0 +1,150 @@
+import re
+import time
+import random
+import asyncio
+import hashlib
+import itertools
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+NARRATIVE_TYPES = ["Diary", "Blog", "Epistolary style", "Prose", "Novel"]
+CHARACTER_TYPES = ["Fictional person", "Author themselves", "Real people", "Anthropomorphized animals/objects/concepts"]
+
+
+class FakeLLMError(Exception):
+    # Injected failures look like provider throttling, so the adaptive client layer reacts to them.
+    status_code = 429
+
+
+def prompt_rng(prompt, seed):
+    return random.Random(int(hashlib.md5(f"{seed}\0{prompt}".encode("utf-8")).hexdigest(), 16))
+
+
+def fake_completion(prompt, rng, output_tokens):
+    """
+    Deterministic answer shaped like what the genre transformation prompts expect, so the parsers downstream still work.
+    """
+    words = re.findall(r"\w+", prompt) or ["lorem"]
+    filler = " ".join(rng.choice(words) for _ in range(output_tokens))
+
+    if "Answer with exactly one line per document" in prompt:
+        count = len(re.findall(r"^\s*Document \d+:", prompt, re.MULTILINE))
+        return "\n".join(f"{i}: yes" for i in range(1, count + 1))
+    if "(yes/no)" in prompt:
+        return "yes"
+    if "Memory area:" in prompt:
+        return (f"```\n1. {filler}\n2. Type of narrative: {rng.choice(NARRATIVE_TYPES)}; "
+                f"Type of main characters: {rng.choice(CHARACTER_TYPES)}.\n3. Analysis: {filler}\n```")
+    if "<overall_summary>" in prompt:
+        return f"<overall_summary>\n{filler}\n</overall_summary>\n<different_perspectives>\n1. {filler}\n2. {filler}\n</different_perspectives>"
+    return filler
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Local stand-in for the chat API: the answer only depends on the prompt and seed,
+    latency is drawn from a normal distribution and a fraction error_rate of calls raise FakeLLMError.
+    Like the provider context cache, prompt prefixes seen before are reported as cache reads in prefix_block units.
+    The latency is the time to first token and every further word takes token_latency, streamed or not.
+    """
+    latency_mean: float = 0.0
+    latency_std: float = 0.0
+    error_rate: float = 0.0
+    token_latency: float = 0.0
+    output_tokens: int = 200
+    max_tokens: int = 4096
+    seed: int = 0
+    prefix_block: int = 64
+
+    _calls = PrivateAttr(default_factory=itertools.count)
+    _prefixes = PrivateAttr(default_factory=set)
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": "fake", "output_tokens": self.output_tokens, "max_tokens": self.max_tokens, "seed": self.seed}
+
+    def _prepare(self, messages):
+        prompt = "\n".join(str(message.content) for message in messages)
+        rng = prompt_rng(prompt, self.seed)
+        latency = max(0.0, rng.gauss(self.latency_mean, self.latency_std))
+        # Errors depend on the call index, so a retried prompt can succeed.
+        call = next(self._calls)
+        failed = prompt_rng(f"{prompt}\0{call}", self.seed).random() < self.error_rate
+        return prompt, rng, latency, failed
+
+    def _cache_read(self, tokens):
+        cached = 0
+        digest = hashlib.md5()
+        for end in range(self.prefix_block, len(tokens) + 1, self.prefix_block):
+            digest.update("\0".join(tokens[end - self.prefix_block:end]).encode("utf-8"))
+            key = digest.copy().digest()
+            if key in self._prefixes:
+                cached = end
+            self._prefixes.add(key)
+        return cached
+
+    def _result(self, prompt, rng):
+        text = fake_completion(prompt, rng, min(self.output_tokens, self.max_tokens))
+        tokens = prompt.split()
+        usage = {"input_tokens": len(tokens), "output_tokens": len(text.split())}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        usage["input_token_details"] = {"cache_read": self._cache_read(tokens)}
+        message = AIMessage(content=text, usage_metadata=usage)
+        token_usage = {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"], "total_tokens": usage["total_tokens"],
+                       "prompt_cache_hit_tokens": usage["input_token_details"]["cache_read"]}
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"token_usage": token_usage, "model_name": "fake"})
+
+    def _chunks(self, prompt, rng):
+        message = self._result(prompt, rng).generations[0].message
+        words = re.findall(r"\s*\S+", message.content)
+        for i, word in enumerate(words):
+            # Usage is reported once, on the last chunk, like stream_usage on the OpenAI API.
+            usage = message.usage_metadata if i == len(words) - 1 else None
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word, usage_metadata=usage))
+
+    def _generation_time(self, result):
+        return self.token_latency * max(0, result.llm_output["token_usage"]["completion_tokens"] - 1)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, rng, latency, failed = self._prepare(messages)
+        time.sleep(latency)
+        if failed:
+            raise FakeLLMError("Injected fake LLM failure")
+        result = self._result(prompt, rng)
+        time.sleep(self._generation_time(result))
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, rng, latency, failed = self._prepare(messages)
+        await asyncio.sleep(latency)
+        if failed:
+            raise FakeLLMError("Injected fake LLM failure")
+        result = self._result(prompt, rng)
+        await asyncio.sleep(self._generation_time(result))
+        return result
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, rng, latency, failed = self._prepare(messages)
+        time.sleep(latency)
+        if failed:
+            raise FakeLLMError("Injected fake LLM failure")
+        for i, chunk in enumerate(self._chunks(prompt, rng)):
+            if i:
+                time.sleep(self.token_latency)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt, rng, latency, failed = self._prepare(messages)
+        await asyncio.sleep(latency)
+        if failed:
+            raise FakeLLMError("Injected fake LLM failure")
+        for i, chunk in enumerate(self._chunks(prompt, rng)):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield chunk
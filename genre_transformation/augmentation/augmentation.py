@@ -1,14 +1,14 @@
 import os
-import random
-import json
+import itertools
 import sys
-from langchain_community.document_loaders import JSONLoader
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from llm_api import get_llm
 
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from dotenv import load_dotenv
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from llm_api import get_llm
+from data_io import stream_documents, shuffle_buffer
+from result_store import save_results, write_results
 
 load_dotenv()
 
@@ -38,25 +38,13 @@ class AugmentationTransformer:
             pass
         return output_list
 
-    def save_results(self, output_list, save_path="result/genre_transformation/augmentation.json"):
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        with open(save_path, "w") as f:
-            json.dump(output_list, f, indent=4)
+    def save_results(self, output_list, save_path="result/genre_transformation/augmentation.jsonl", compression=None):
+        save_results(output_list, save_path, compression)
 
 if __name__ == "__main__":
-    loader = JSONLoader(
-        file_path='./data/wikibooks.jsonl',
-        jq_schema='.text',
-        text_content=False,
-        json_lines=True
-    )
-    dataset = loader.load()
-    random.shuffle(dataset)
-   
-    print(dataset[0], dataset[1], sep = '\n')
-    dataset = dataset[:10] # For testing
-    
+    dataset = shuffle_buffer(stream_documents('./data/wikibooks.jsonl'), buffer_size=int(os.getenv("SHUFFLE_BUFFER", 10000)))
+    dataset = itertools.islice(dataset, 10) # For testing
+
     summarizer = AugmentationTransformer()
 
-    output_list = summarizer.transform_dataset(dataset)
-    summarizer.save_results(output_list)
\ No newline at end of file
+    write_results(summarizer.transform_dataset(dataset), "result/genre_transformation/augmentation.jsonl")
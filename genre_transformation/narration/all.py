@@ -2,50 +2,137 @@
 # TODO: Add assertion / feedback loop
 import os
 import re
-import random
+import itertools
+import asyncio
 import Levenshtein
-from langchain_community.document_loaders import JSONLoader
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-import json
+from langchain_core.rate_limiters import InMemoryRateLimiter
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
-from llm_api import get_llm
+from llm_api import get_llm, get_llm_cache
+from data_io import stream_documents, shuffle_buffer
+from result_store import save_results, result_writer
+from checkpoint import CheckpointStore, prompt_version, add_counts
+from prefilter import LocalPrefilter
+from metrics import MetricsRecorder
+from batch_api import BatchClient, document_id
+from streaming import StreamingGenerator, PartialWriter, RepetitionStop, LengthBudget, LENGTH_BUDGETS
+
+class BKTree:
+    """
+    Burkhard-Keller tree over Levenshtein distance, so a radius query only visits a small part of the keys.
+    """
+    def __init__(self):
+        self.root = None
+        self.order = {}
+
+    def add(self, word):
+        if word in self.order:
+            return
+        self.order[word] = len(self.order)
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = Levenshtein.distance(word, node[0])
+            if distance not in node[1]:
+                node[1][distance] = (word, {})
+                return
+            node = node[1][distance]
+
+    def search(self, word, radius):
+        """
+        Return (distance, word) for every word within radius of the query.
+        """
+        if self.root is None:
+            return []
+        results = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            distance = Levenshtein.distance(word, node_word)
+            if distance <= radius:
+                results.append((distance, node_word))
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return results
+
 
 class FuzzyDict:
     """
     A dictionary that can get the value by a key with a fuzzy match.
+    Lookups go through a memo of raw strings, then a normalized alias table, then a BK-tree radius query.
     """
     def __init__(self, dict):
         self.dict = dict
-        
+        self.memo = {}
+        self.aliases = {}
+        self.index = BKTree()
+        for k in dict:
+            self._index_key(k)
+
+    @staticmethod
+    def normalize(key):
+        return " ".join(re.sub(r"[^\w/ ]+", " ", key.lower()).split())
+
+    def _index_key(self, k):
+        self.aliases.setdefault(self.normalize(k), k)
+        self.index.add(k)
+
     def fuzzy_get(self, key, threshold=0.3):
         if key in self.dict:
             return key
-        minn_distance   = 1000
-        minn_key = None
-        for k in self.dict:
-            # print(f"key: {key}, k: {k}")
-            edit_distance = Levenshtein.distance(k, key)
-            if edit_distance < minn_distance and edit_distance / len(k) < threshold:
-                minn_distance = edit_distance
-                minn_key = k
-        
-        if minn_key:
-            return minn_key
-        else:
+        if not isinstance(key, str):
             return key
+        cache_key = (key, threshold)
+        if cache_key in self.memo:
+            return self.memo[cache_key]
+
+        minn_key = self.aliases.get(self.normalize(key))
+        if minn_key is None and threshold < 1:
+            # distance / len(k) < threshold and len(k) <= len(key) + distance bound the search radius.
+            radius = int(threshold * len(key) / (1 - threshold))
+            candidates = [(distance, self.index.order[k], k) for distance, k in self.index.search(key, radius) if distance / len(k) < threshold]
+            if candidates:
+                minn_key = min(candidates)[2]
+
+        result = minn_key if minn_key else key
+        self.memo[cache_key] = result
+        return result
 
     def value_add(self, key, D=1):
+        if key is None:
+            return
         key = self.fuzzy_get(key)
         if key not in self.dict:
             self.dict[key] = D
+            self._index_key(key)
+            # A new key can become the best match for strings that previously matched nothing.
+            self.memo.clear()
         else:
             self.dict[key] += D
+        return key
 
 class NarrativeTransformer:
-    def __init__(self):
-        self.llm = get_llm()
+    def __init__(self, max_concurrency=16, requests_per_second=None, prefilter=None, filter_batch_size=8, filter_batch_chars=8000, dedup=None, prompt_layout="text_first",
+                 streaming=False, partial_writer=None):
+        self.max_concurrency = max_concurrency
+        # With streaming, chain2 output is consumed as it arrives, cut short by the stop conditions of write_stop_conditions,
+        # and every delta goes to the optional PartialWriter.
+        self.streaming = streaming
+        self.partial_writer = partial_writer
+        # Optional LocalPrefilter, off by default: it rejects short and mostly non-English documents without asking the LLM.
+        self.prefilter = prefilter
+        # Optional MinHashDeduplicator; near-duplicates of an earlier document are rejected like prefiltered ones.
+        self.dedup = dedup
+        self.filter_batch_size = filter_batch_size
+        self.filter_batch_chars = filter_batch_chars
+        rate_limiter = InMemoryRateLimiter(requests_per_second=requests_per_second) if requests_per_second else None
+        self.llm = get_llm(rate_limiter=rate_limiter)
+        self.metrics = MetricsRecorder()
         self.parser = StrOutputParser()
         
         self.can_be_modified_template = PromptTemplate.from_template("""
@@ -53,6 +140,13 @@ class NarrativeTransformer:
         {text}
         Is this text meaningful (has enough content) and feasible to be rewritten as a narrative? (yes/no)
         """)
+
+        self.batch_can_be_modified_template = PromptTemplate.from_template("""
+        Narrative types: Diary, Epistolary style, Prose, Novel.
+        {texts}
+        For each numbered document above, is the text meaningful (has enough content) and feasible to be rewritten as a narrative?
+        Answer with exactly one line per document in the format "<number>: yes" or "<number>: no", and nothing else.
+        """)
         
         self.template1 = PromptTemplate.from_template("""
         {text}
@@ -99,12 +193,128 @@ class NarrativeTransformer:
         {suggestions}
         """)
         
-        self.narrative_dict = FuzzyDict({"Diary": 0, "Blog": 0, "Epistolary style": 0, "Prose": 0, "Novel": 0})
-        self.character_dict = FuzzyDict({"Fictional person": 0, "Author themselves": 0, "Real people": 0, "Anthropomorphized animals/objects/concepts": 0})
+        if prompt_layout == "shared_prefix":
+            self.use_shared_prefix_layout()
+        elif prompt_layout != "text_first":
+            raise ValueError(f"Unknown prompt_layout: {prompt_layout}")
+        # Records are tagged with the layout, so outputs of the two layouts can be compared side by side.
+        self.layout_tag = [prompt_layout] if prompt_layout != "text_first" else []
+
+        self.default_memory = {
+            "narrative_dict": {"Diary": 0, "Blog": 0, "Epistolary style": 0, "Prose": 0, "Novel": 0},
+            "character_dict": {"Fictional person": 0, "Author themselves": 0, "Real people": 0, "Anthropomorphized animals/objects/concepts": 0},
+        }
+        self.narrative_dict = FuzzyDict(dict(self.default_memory["narrative_dict"]))
+        self.character_dict = FuzzyDict(dict(self.default_memory["character_dict"]))
         
-        self.can_be_modified_chain = self.can_be_modified_template | self.llm | self.parser
-        self.chain1 = self.template1 | self.llm | self.parser
-        self.chain2 = self.template2 | self.llm | self.parser
+        self.can_be_modified_chain = (self.can_be_modified_template | self.llm | self.parser).with_config(callbacks=[self.metrics.handler("can_be_modified")])
+        self.batch_can_be_modified_chain = (self.batch_can_be_modified_template | self.llm | self.parser).with_config(callbacks=[self.metrics.handler("batch_can_be_modified")])
+        self.chain1 = (self.template1 | self.llm | self.parser).with_config(callbacks=[self.metrics.handler("chain1")])
+        self.chain2 = (self.template2 | self.llm | self.parser).with_config(callbacks=[self.metrics.handler("chain2")])
+        self.chain2_stream = StreamingGenerator(self.template2, self.llm, "chain2", self.metrics)
+        # Guards the memory area so every plan reads and updates the counters atomically.
+        # Created per run in atransform_dataset, since asyncio primitives bind to one event loop.
+        self.memory_lock = None
+        self.prompt_version = prompt_version(self.can_be_modified_template, self.batch_can_be_modified_template, self.template1, self.template2)
+
+    def use_shared_prefix_layout(self):
+        """
+        Same prompts laid out as a fixed preamble, then the document, then the stage's own instructions, with the
+        memory area and suggestions that change on every call last. The stages of one document then share the preamble
+        and the document as a prompt prefix, and all requests share the preamble, so the provider context cache can
+        serve both. Putting every fixed instruction before the document instead loses the prefix shared by the stages
+        of a document: on the fake model (benchmark.py --docs 40) that lowered cache hits from 28.1% to 9.5%.
+        """
+        preamble = """
+        As a professional narrative writing expert, you know:
+        1. Types of narrative:
+           - Diary
+           - Blog
+           - Epistolary style 
+           - Prose
+           - Novel
+        2. Types of main characters:
+           - Fictional person
+           - Author themselves
+           - Real people
+           - Anthropomorphized animals/objects/concepts
+
+        You will be given a text and one task about transforming it into a narrative.
+        """
+        document = preamble + """
+        ---
+        Given text:
+        {text}
+
+        ---
+        Task:
+        """
+
+        self.can_be_modified_template = PromptTemplate.from_template(document + """
+        Is the given text meaningful (has enough content) and feasible to be rewritten as a narrative? (yes/no)
+        """)
+
+        self.batch_can_be_modified_template = PromptTemplate.from_template(preamble + """
+        ---
+        Given texts:
+        {texts}
+
+        ---
+        Task:
+        For each numbered document above, is the text meaningful (has enough content) and feasible to be rewritten as a narrative?
+        Answer with exactly one line per document in the format "<number>: yes" or "<number>: no", and nothing else.
+        """)
+
+        self.template1 = PromptTemplate.from_template(document + """
+        Your role is to guide another AI in transforming the given text into a narrative form. You won't be writing the narrative itself, but rather completing the following three tasks, which another AI will reference to generate the narrative:
+        1. Summarize the content of the given text.
+        2. Choose the type of narrative, Person(first, second, third), and the type of main characters.
+        3. Based on the given text, analyze how to transform the text into the (type_of_narrative, person, type_of_main_characters).
+
+        Output in a code block enclosed by triple backticks in the following format:
+        ```
+        1. {{summary}}
+        2. Type of narrative: {{type_of_narrative}}; Type of main characters: {{type_of_main_characters}}.
+        3. Analysis: {{analysis}}
+        ```
+        Do not provide any other information except the guidance of the three questions above.
+        You need to diversify the selection of type_of_narrative to ensure an even distribution, in order to generate a diverse range of narratives.
+
+        ---
+        Memory area:
+        Here is the number of times you have chosen specific type_of_narrative:
+        {narrative_dict}, and the number of times you have chosen specific type_of_main_characters: {character_dict}.
+        """)
+
+        self.template2 = PromptTemplate.from_template(document + """
+        Transform the given text, which could be of any type, into type_of_narrative. The requirements are:
+        1. Avoid unnecessary filler content.
+        2. Integrate sufficient background information about the given text in the narrative.
+        3. Pay attention to causal logic in the narrative.
+        4. Refer to the following suggestions to complete this task:
+        {suggestions}
+        """)
+
+    def memory_state(self):
+        return {"narrative_dict": dict(self.narrative_dict.dict), "character_dict": dict(self.character_dict.dict)}
+
+    def restore_memory(self, state):
+        # Checkpoints of async and pipeline runs only hold the counts their plans added, so start from the defaults.
+        if state:
+            state = add_counts(self.default_memory, state)
+            self.narrative_dict = FuzzyDict(state["narrative_dict"])
+            self.character_dict = FuzzyDict(state["character_dict"])
+
+    def apply_plan(self, type_of_narrative, type_of_main_characters):
+        """
+        Count one plan in the memory area. Returns the counts it added, as a checkpoint delta.
+        """
+        delta = {}
+        for name, counter, value in (("narrative_dict", self.narrative_dict, type_of_narrative), ("character_dict", self.character_dict, type_of_main_characters)):
+            key = counter.value_add(value)
+            if key is not None:
+                delta[name] = {key: 1}
+        return delta
 
     def yes_in_string(self, s):
         return "yes" in s.lower()
@@ -114,6 +324,76 @@ class NarrativeTransformer:
         assert response is not None
         return self.yes_in_string(response)
     
+    def skip_done(self, dataset, checkpoint):
+        """
+        Drop documents the checkpoint already has. They still go through the dedup stage, in stream order, so a resumed
+        run keeps rejecting near-duplicates of documents finished before it was interrupted.
+        """
+        for data in dataset:
+            if not checkpoint.is_done(data.page_content):
+                yield data
+            elif self.dedup:
+                self.dedup.check(data.page_content)
+
+    def pack_feasibility_batches(self, dataset):
+        """
+        Lazily group documents for the feasibility check. Yields (batch, needs_llm):
+        documents rejected by the local prefilter or the dedup stage come out alone with needs_llm=False,
+        short documents are packed together up to filter_batch_size / filter_batch_chars.
+        """
+        batch, batch_chars = [], 0
+        for data in dataset:
+            if self.prefilter and not self.prefilter(data.page_content):
+                self.metrics.increment("prefilter_rejected")
+                yield [data], False
+                continue
+            if self.dedup and self.dedup.check(data.page_content) is not None:
+                self.metrics.increment("near_duplicates")
+                yield [data], False
+                continue
+            text_chars = len(data.page_content)
+            if batch and (len(batch) >= self.filter_batch_size or batch_chars + text_chars > self.filter_batch_chars):
+                yield batch, True
+                batch, batch_chars = [], 0
+            batch.append(data)
+            batch_chars += text_chars
+        if batch:
+            yield batch, True
+
+    def batch_input(self, batch):
+        return {"texts": "\n".join(f"Document {i}:\n<<<\n{data.page_content}\n>>>" for i, data in enumerate(batch, start=1))}
+
+    def parse_batch_response(self, response, batch_size):
+        verdicts = [None] * batch_size
+        for number, answer in re.findall(r"(\d+)\s*[:.)-]\s*(yes|no)", response, re.IGNORECASE):
+            if 1 <= int(number) <= batch_size:
+                verdicts[int(number) - 1] = answer.lower() == "yes"
+        return verdicts
+
+    def classify_batch(self, batch):
+        if len(batch) == 1:
+            return [self.can_be_modified(batch[0].page_content)]
+        verdicts = self.parse_batch_response(self.batch_can_be_modified_chain.invoke(self.batch_input(batch)), len(batch))
+        # Documents the model skipped fall back to the single-document check.
+        return [self.can_be_modified(data.page_content) if verdict is None else verdict for data, verdict in zip(batch, verdicts)]
+
+    async def aclassify_batch(self, batch):
+        if len(batch) == 1:
+            return [self.yes_in_string(await self.can_be_modified_chain.ainvoke({"text": batch[0].page_content}))]
+        verdicts = self.parse_batch_response(await self.batch_can_be_modified_chain.ainvoke(self.batch_input(batch)), len(batch))
+        for i, verdict in enumerate(verdicts):
+            if verdict is None:
+                verdicts[i] = self.yes_in_string(await self.can_be_modified_chain.ainvoke({"text": batch[i].page_content}))
+        return verdicts
+
+    def iter_feasibility(self, dataset):
+        """
+        Streaming feasibility stage yielding (data, feasible) as soon as each batch is classified.
+        """
+        for batch, needs_llm in self.pack_feasibility_batches(dataset):
+            verdicts = self.classify_batch(batch) if needs_llm else [False] * len(batch)
+            yield from zip(batch, verdicts)
+
     def extract_type_and_character(self, text):
         narrative_pattern = r"Type of narrative: ([^;]+);"
         character_pattern = r"Type of main characters: ([^.]+)\."
@@ -122,54 +402,367 @@ class NarrativeTransformer:
         
         type_of_narrative = narrative_match.group(1) if narrative_match else None
         type_of_main_characters = character_match.group(1) if character_match else None
+        if type_of_narrative is None:
+            self.metrics.increment("extract_type_of_narrative_failures")
+        if type_of_main_characters is None:
+            self.metrics.increment("extract_type_of_main_characters_failures")
         
         return (type_of_narrative, type_of_main_characters)
     
-    def transform_dataset(self, dataset):
-        output_list = []
+    def transform_document(self, data):
+        response = self.chain1.invoke({"text": data.page_content, "narrative_dict": self.narrative_dict.dict, "character_dict": self.character_dict.dict})
         
-        dataset = [data for data in dataset if self.can_be_modified(data.page_content)]
+        # print("response:", response)
         
-        for data in dataset:
-            response = self.chain1.invoke({"text": data.page_content, "narrative_dict": self.narrative_dict.dict, "character_dict": self.character_dict.dict})
-            
-            # print("response:", response)
-            
+        type_of_narrative, type_of_main_characters = self.extract_type_and_character(response)
+        
+        # print("type_of_narrative:", type_of_narrative, "type_of_main_characters:", type_of_main_characters)
+
+        self.apply_plan(type_of_narrative, type_of_main_characters)
+        
+        suggestions = {"type_of_narrative": type_of_narrative, "type_of_main_characters": type_of_main_characters}
+        return self.write_narrative(data, suggestions)
+
+    def write_stop_conditions(self, type_of_narrative):
+        budget = LENGTH_BUDGETS.get(self.narrative_dict.fuzzy_get(type_of_narrative), LENGTH_BUDGETS["Novel"])
+        return [RepetitionStop(), LengthBudget(budget)]
+
+    def _stream_arguments(self, data, suggestions):
+        key = document_id(data.page_content)
+        on_delta = self.partial_writer.callback(key) if self.partial_writer else None
+        return key, self.write_stop_conditions(suggestions["type_of_narrative"]), on_delta
+
+    def _narrative_record(self, data, response, stop_reason=None):
+        # Generations cut short by a stop condition keep their partial text and are tagged with the reason.
+        tag = list(self.layout_tag) + ([f"early_stop:{stop_reason}"] if stop_reason else [])
+        return {"original_text": data.page_content, "transformed_text": response, "type": "narration", "tag": tag}
+
+    def write_narrative(self, data, suggestions):
+        inputs = {"text": data.page_content, "suggestions": suggestions}
+        if not self.streaming:
+            return self._narrative_record(data, self.chain2.invoke(inputs))
+        key, stop_conditions, on_delta = self._stream_arguments(data, suggestions)
+        response, stop_reason = self.chain2_stream.generate(inputs, stop_conditions, on_delta)
+        if self.partial_writer:
+            self.partial_writer.done(key, stop_reason)
+        return self._narrative_record(data, response, stop_reason)
+
+    async def awrite_narrative(self, data, suggestions):
+        inputs = {"text": data.page_content, "suggestions": suggestions}
+        if not self.streaming:
+            return self._narrative_record(data, await self.chain2.ainvoke(inputs))
+        key, stop_conditions, on_delta = self._stream_arguments(data, suggestions)
+        response, stop_reason = await self.chain2_stream.agenerate(inputs, stop_conditions, on_delta)
+        if self.partial_writer:
+            self.partial_writer.done(key, stop_reason)
+        return self._narrative_record(data, response, stop_reason)
+
+    def iter_transform(self, dataset, checkpoint=None):
+        """
+        Lazily transform any iterable of documents, yielding each record as soon as it is produced.
+        With a checkpoint, finished documents are skipped and the memory area is restored from the last run.
+        """
+        if checkpoint:
+            self.restore_memory(checkpoint.state)
+            dataset = self.skip_done(dataset, checkpoint)
+        for data, feasible in self.iter_feasibility(dataset):
+            if feasible:
+                yield self.transform_document(data)
+            if checkpoint:
+                checkpoint.mark_done(data.page_content, self.memory_state())
+
+    def transform_dataset(self, dataset):
+        return list(self.iter_transform(dataset))
+
+    async def atransform_document(self, data, semaphore):
+        """
+        Returns (record, memory_delta), memory_delta being the counts this document's plan added to the memory area.
+        """
+        async with semaphore:
+            async with self.memory_lock:
+                memory = self.memory_state()
+            response = await self.chain1.ainvoke({"text": data.page_content, **memory})
+
             type_of_narrative, type_of_main_characters = self.extract_type_and_character(response)
-            
-            # print("type_of_narrative:", type_of_narrative, "type_of_main_characters:", type_of_main_characters)
 
-            self.narrative_dict.value_add(type_of_narrative)
-            self.character_dict.value_add(type_of_main_characters)
-            
+            # Counters are updated in plan-completion order, one plan at a time.
+            async with self.memory_lock:
+                memory_delta = self.apply_plan(type_of_narrative, type_of_main_characters)
+
             suggestions = {"type_of_narrative": type_of_narrative, "type_of_main_characters": type_of_main_characters}
-            response = self.chain2.invoke({"text": data.page_content, "suggestions": suggestions})
-            
-            output_list.append({"original_text": data.page_content, "transformed_text": response, "type": "narration", "tag": []})
-        
-        return output_list
+            return await self.awrite_narrative(data, suggestions), memory_delta
 
-    def save_results(self, output_list, save_dir="result/genre_transformation"):
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        
-        with open(f"{save_dir}/narration.json", "w") as f:
-            json.dump(output_list, f, indent=4)
+    async def atransform_dataset(self, dataset, checkpoint=None, writer=None):
+        """
+        Async version of transform_dataset with at most max_concurrency documents in flight.
+        The output keeps the order of the input dataset; with a writer, records are also written as they complete.
+        """
+        if checkpoint:
+            self.restore_memory(checkpoint.state)
+            dataset = list(self.skip_done(dataset, checkpoint))
+
+        self.memory_lock = asyncio.Lock()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run(data):
+            record, memory_delta = await self.atransform_document(data, semaphore)
+            if writer:
+                writer.write(record)
+            if checkpoint:
+                # Documents finish out of order, so a snapshot of the counters would include plans of unfinished ones.
+                checkpoint.mark_done(data.page_content, delta=memory_delta)
+            return record
+
+        async def process(batch, needs_llm):
+            # Accepted documents start generating as soon as their own batch is classified.
+            verdicts = [False] * len(batch)
+            if needs_llm:
+                async with semaphore:
+                    verdicts = await self.aclassify_batch(batch)
+            accepted = []
+            for data, feasible in zip(batch, verdicts):
+                if feasible:
+                    accepted.append(data)
+                elif checkpoint:
+                    checkpoint.mark_done(data.page_content)
+            return await asyncio.gather(*(run(data) for data in accepted))
+
+        results = await asyncio.gather(*(process(batch, needs_llm) for batch, needs_llm in self.pack_feasibility_batches(dataset)))
+        return [record for batch_records in results for record in batch_records]
+
+    async def apipeline_dataset(self, dataset, writer, checkpoint=None, feasibility_workers=4, plan_workers=None, write_workers=None,
+                                queue_size=64, max_in_flight=256):
+        """
+        Pipelined version of atransform_dataset: feasibility, plan and write run as separate worker pools connected by
+        bounded queues, so different documents overlap across stages. Documents are read lazily and at most
+        max_in_flight of them are admitted past the slowest unfinished plan, which bounds memory for any dataset size.
+        Every plan reads the memory area as it is when the plan starts; the counters are updated from the finished
+        plans strictly in input order. Records are written in completion order; returns the number written.
+        A document whose stage fails is counted in the metrics and left unchecked, so the next run retries it.
+        """
+        if checkpoint:
+            self.restore_memory(checkpoint.state)
+            dataset = self.skip_done(dataset, checkpoint)
+        plan_workers = plan_workers or self.max_concurrency
+        write_workers = write_workers or self.max_concurrency
+
+        feasibility_queue = asyncio.Queue(maxsize=queue_size)
+        plan_queue = asyncio.Queue(maxsize=queue_size)
+        write_queue = asyncio.Queue(maxsize=queue_size)
+        order = asyncio.Condition()
+        pending = {}
+        deltas = {}
+        finished = {}
+        next_applied = 0
+        written = 0
+
+        async def apply(seq, plan):
+            # plan is (type_of_narrative, type_of_main_characters), or None for a document that produced no plan.
+            nonlocal next_applied
+            async with order:
+                pending[seq] = plan
+                while next_applied in pending:
+                    plan = pending.pop(next_applied)
+                    if plan:
+                        delta = self.apply_plan(*plan)
+                        if next_applied in finished:
+                            done(finished.pop(next_applied), delta)
+                        else:
+                            deltas[next_applied] = delta
+                    next_applied += 1
+                order.notify_all()
+
+        def done(text, delta):
+            # Only this document's own plan: the counters already include plans of documents still being written.
+            if checkpoint and text is not None:
+                checkpoint.mark_done(text, delta=delta)
+
+        async def checkpoint_written(seq, text):
+            # The narrative can be written before earlier plans let this one be applied; the checkpoint entry then
+            # waits for its delta. text is None for a failed write, whose plan stays out of the checkpoint.
+            async with order:
+                if seq in deltas:
+                    done(text, deltas.pop(seq))
+                else:
+                    finished[seq] = text
+
+        async def produce():
+            seq = 0
+            for batch, needs_llm in self.pack_feasibility_batches(dataset):
+                async with order:
+                    await order.wait_for(lambda: seq == next_applied or seq + len(batch) - next_applied <= max_in_flight)
+                await feasibility_queue.put(([(seq + i, data) for i, data in enumerate(batch)], needs_llm))
+                seq += len(batch)
+
+        async def feasibility(item):
+            batch, needs_llm = item
+            verdicts = [False] * len(batch)
+            if needs_llm:
+                try:
+                    verdicts = await self.aclassify_batch([data for _, data in batch])
+                except Exception:
+                    self.metrics.increment("pipeline_feasibility_failures")
+                    verdicts = [None] * len(batch)
+            for (seq, data), feasible in zip(batch, verdicts):
+                if feasible:
+                    await plan_queue.put((seq, data))
+                    continue
+                await apply(seq, None)
+                if checkpoint and feasible is not None:
+                    checkpoint.mark_done(data.page_content)
+
+        async def plan(item):
+            seq, data = item
+            try:
+                response = await self.chain1.ainvoke({"text": data.page_content, **self.memory_state()})
+            except Exception:
+                self.metrics.increment("pipeline_plan_failures")
+                await apply(seq, None)
+                return
+            type_of_narrative, type_of_main_characters = self.extract_type_and_character(response)
+            await apply(seq, (type_of_narrative, type_of_main_characters))
+            await write_queue.put((seq, data, {"type_of_narrative": type_of_narrative, "type_of_main_characters": type_of_main_characters}))
+
+        async def write(item):
+            nonlocal written
+            seq, data, suggestions = item
+            try:
+                record = await self.awrite_narrative(data, suggestions)
+            except Exception:
+                self.metrics.increment("pipeline_write_failures")
+                await checkpoint_written(seq, None)
+                return
+            writer.write(record)
+            written += 1
+            await checkpoint_written(seq, data.page_content)
+
+        async def stage(queue, handle, workers, next_queue=None, next_workers=0):
+            async def worker():
+                while (item := await queue.get()) is not None:
+                    await handle(item)
+            await asyncio.gather(*(worker() for _ in range(workers)))
+            # Every worker of the next stage stops at its own sentinel.
+            for _ in range(next_workers):
+                await next_queue.put(None)
+
+        async def source():
+            await produce()
+            for _ in range(feasibility_workers):
+                await feasibility_queue.put(None)
+
+        await asyncio.gather(
+            source(),
+            stage(feasibility_queue, feasibility, feasibility_workers, plan_queue, plan_workers),
+            stage(plan_queue, plan, plan_workers, write_queue, write_workers),
+            stage(write_queue, write, write_workers),
+        )
+        return written
+
+    def iter_transform_batch(self, dataset, client, checkpoint=None):
+        """
+        Provider batch API version of iter_transform: the feasibility, plan and write stages are each rendered for the
+        whole dataset, submitted as one batch and joined back to the documents by document_id.
+        All plans read the same memory area snapshot; the counters are then updated in input order with the plans of
+        the documents that were written, each checkpointed with its own plan counts.
+        Documents whose request failed are not checkpointed, so the next run picks them up again.
+        """
+        if checkpoint:
+            self.restore_memory(checkpoint.state)
+            dataset = self.skip_done(dataset, checkpoint)
+        documents = {}
+        for data in dataset:
+            documents.setdefault(document_id(data.page_content), data)
+
+        verdicts, prompts, packed = {}, {}, {}
+        for i, (batch, needs_llm) in enumerate(self.pack_feasibility_batches(documents.values())):
+            if not needs_llm:
+                verdicts[document_id(batch[0].page_content)] = False
+            elif len(batch) == 1:
+                prompts[document_id(batch[0].page_content)] = self.can_be_modified_template.format(text=batch[0].page_content)
+            else:
+                packed[f"batch-{i}"] = batch
+                prompts[f"batch-{i}"] = self.batch_can_be_modified_template.format(**self.batch_input(batch))
+        responses = client.run_stage("narration-feasibility", prompts, self.metrics)
+
+        retry = {}
+        for custom_id, response in responses.items():
+            if custom_id not in packed:
+                verdicts[custom_id] = self.yes_in_string(response)
+                continue
+            batch = packed[custom_id]
+            for data, verdict in zip(batch, self.parse_batch_response(response, len(batch))):
+                if verdict is None:
+                    # Documents the model skipped fall back to the single-document check.
+                    retry[document_id(data.page_content)] = self.can_be_modified_template.format(text=data.page_content)
+                else:
+                    verdicts[document_id(data.page_content)] = verdict
+        if retry:
+            for custom_id, response in client.run_stage("narration-feasibility-retry", retry, self.metrics).items():
+                verdicts[custom_id] = self.yes_in_string(response)
+
+        accepted = [custom_id for custom_id in documents if verdicts.get(custom_id)]
+        memory = self.memory_state()
+        plans = client.run_stage("narration-plan", {
+            custom_id: self.template1.format(text=documents[custom_id].page_content, **memory) for custom_id in accepted
+        }, self.metrics)
+
+        suggestions = {}
+        for custom_id in accepted:
+            if custom_id not in plans:
+                continue
+            type_of_narrative, type_of_main_characters = self.extract_type_and_character(plans[custom_id])
+            suggestions[custom_id] = {"type_of_narrative": type_of_narrative, "type_of_main_characters": type_of_main_characters}
+        narratives = client.run_stage("narration-write", {
+            custom_id: self.template2.format(text=documents[custom_id].page_content, suggestions=suggestions[custom_id]) for custom_id in suggestions
+        }, self.metrics)
+
+        for custom_id, data in documents.items():
+            if custom_id not in verdicts or (verdicts[custom_id] and custom_id not in narratives):
+                continue
+            memory_delta = None
+            if verdicts[custom_id]:
+                # A plan whose write failed is not counted: the document is planned again on the next run.
+                memory_delta = self.apply_plan(suggestions[custom_id]["type_of_narrative"], suggestions[custom_id]["type_of_main_characters"])
+                yield {"original_text": data.page_content, "transformed_text": narratives[custom_id], "type": "narration", "tag": list(self.layout_tag)}
+            if checkpoint:
+                checkpoint.mark_done(data.page_content, delta=memory_delta)
+
+    def save_results(self, output_list, save_dir="result/genre_transformation", compression=None):
+        save_results(output_list, f"{save_dir}/narration.jsonl", compression)
           
           
 if __name__ == "__main__":
-    loader = JSONLoader(
-        file_path='./data/wikibooks.jsonl',
-        jq_schema='.text',
-        text_content=False,
-        json_lines=True
-    )
-    dataset = loader.load()
-    random.shuffle(dataset)
-
-    print(dataset[0], dataset[1], sep = '\n')
-    dataset = dataset[:10] # For testing
-
-    transformer = NarrativeTransformer()
-    output_list = transformer.transform_dataset(dataset)
-    transformer.save_results(output_list)         
\ No newline at end of file
+    dataset = shuffle_buffer(stream_documents('./data/wikibooks.jsonl'), buffer_size=int(os.getenv("SHUFFLE_BUFFER", 10000)))
+    dataset = itertools.islice(dataset, 10) # For testing
+
+    dedup = None
+    if os.getenv("DEDUP_THRESHOLD"):
+        from dedup import MinHashDeduplicator, DEFAULT_MAX_DOCUMENTS
+        # DEDUP_MAX_DOCUMENTS=0 keeps every signature.
+        dedup = MinHashDeduplicator(threshold=float(os.getenv("DEDUP_THRESHOLD")), max_documents=int(os.getenv("DEDUP_MAX_DOCUMENTS", DEFAULT_MAX_DOCUMENTS)) or None)
+    partial_writer = None
+    if os.getenv("STREAM_MODE"):
+        partial_writer = PartialWriter("result/genre_transformation/partial/narration.jsonl")
+    transformer = NarrativeTransformer(max_concurrency=int(os.getenv("MAX_CONCURRENCY", 16)), prefilter=LocalPrefilter() if os.getenv("PREFILTER") else None, dedup=dedup, prompt_layout=os.getenv("PROMPT_LAYOUT", "text_first"),
+                                       streaming=bool(os.getenv("STREAM_MODE")), partial_writer=partial_writer)
+    checkpoint = CheckpointStore("result/genre_transformation/checkpoints/narration.jsonl", "narration", transformer.prompt_version)
+    with checkpoint, result_writer("result/genre_transformation/narration.jsonl") as writer:
+        if os.getenv("BATCH_MODE"):
+            client = BatchClient(work_dir="result/genre_transformation/batches/narration", poll_interval=float(os.getenv("BATCH_POLL_INTERVAL", 30)))
+            for record in transformer.iter_transform_batch(dataset, client, checkpoint):
+                writer.write(record)
+        elif os.getenv("PIPELINE_MODE"):
+            asyncio.run(transformer.apipeline_dataset(dataset, writer, checkpoint))
+        elif os.getenv("ASYNC_MODE"):
+            asyncio.run(transformer.atransform_dataset(list(dataset), checkpoint, writer))
+        else:
+            for record in transformer.iter_transform(dataset, checkpoint):
+                writer.write(record)
+
+    if partial_writer:
+        partial_writer.close()
+    transformer.metrics.export("result/genre_transformation/metrics/narration")
+    if get_llm_cache():
+        print("LLM cache:", get_llm_cache().stats())
+    if dedup:
+        print("Dedup:", dedup.stats())
@@ -1,17 +1,24 @@
 import os
-import json
-import random
+import sys
+import itertools
 from dotenv import load_dotenv
-from langchain_community.document_loaders import JSONLoader
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from llm_api import get_llm
+from data_io import stream_documents, shuffle_buffer
+from result_store import save_results, write_results
+from checkpoint import CheckpointStore, prompt_version
+from chunking import MapReduceCondenser
+from metrics import MetricsRecorder
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from llm_api import get_llm
 
 load_dotenv()
 
 class OverallSummaryTransformer:
-    def __init__(self):
+    def __init__(self, chunk_size=None, chunk_overlap=None):
         self.llm = get_llm()
+        self.metrics = MetricsRecorder()
+        self.condenser = MapReduceCondenser(self.llm, chunk_size, chunk_overlap, metrics=self.metrics) if chunk_size else None
         self.parser = StrOutputParser()
 
         self.overall_summary_prompt = PromptTemplate.from_template("""{text}
@@ -20,32 +27,32 @@ class OverallSummaryTransformer:
         2. Incorporate main ideas and essential information, eliminating extraneous language and focusing on critical aspects.
         3. Ensure that the summary is self-contained and does not require the reader to refer back to the original text for context.""")
 
-        self.overall_summary_chain = self.overall_summary_prompt | self.llm | self.parser
+        self.overall_summary_chain = (self.overall_summary_prompt | self.llm | self.parser).with_config(callbacks=[self.metrics.handler("overall_summary")])
+        self.prompt_version = prompt_version(self.overall_summary_prompt)
 
-    def transform_dataset(self, dataset):
-        output_list = []
+    def iter_transform(self, dataset, checkpoint=None):
         for data in dataset:
-            summary = self.overall_summary_chain.invoke({"text": data.page_content})
-            output_list.append({"original_text": data.page_content, "transformed_text": summary, "type": "overall_summary", "tag": []})
+            if checkpoint and checkpoint.is_done(data.page_content):
+                continue
+            text = self.condenser.condense(data.page_content) if self.condenser else data.page_content
+            summary = self.overall_summary_chain.invoke({"text": text})
+            yield {"original_text": data.page_content, "transformed_text": summary, "type": "overall_summary", "tag": []}
+            if checkpoint:
+                checkpoint.mark_done(data.page_content)
 
-        return output_list
+    def transform_dataset(self, dataset):
+        return list(self.iter_transform(dataset))
 
-    def save_results(self, output_list, save_path="result/genre_transformation/overall_summary.json"):
-        os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        with open(save_path, "w") as f:
-            json.dump(output_list, f, indent=4)
+    def save_results(self, output_list, save_path="result/genre_transformation/overall_summary.jsonl", compression=None):
+        save_results(output_list, save_path, compression)
 
 if __name__ == "__main__":
-    loader = JSONLoader(
-        file_path='./data/wikibooks.jsonl',
-        jq_schema='.text',
-        text_content=False,
-        json_lines=True
-    )
-    dataset = loader.load()
-    random.shuffle(dataset)
-
-    summarizer = OverallSummaryTransformer()
-
-    output_list = summarizer.transform_dataset(dataset[:10])  # For testing
-    summarizer.save_results(output_list)
+    dataset = shuffle_buffer(stream_documents('./data/wikibooks.jsonl'), buffer_size=int(os.getenv("SHUFFLE_BUFFER", 10000)))
+    dataset = itertools.islice(dataset, 10) # For testing
+
+    chunk_size = int(os.getenv("CHUNK_SIZE", 0)) or None
+    summarizer = OverallSummaryTransformer(chunk_size=chunk_size, chunk_overlap=int(os.getenv("CHUNK_OVERLAP")) if os.getenv("CHUNK_OVERLAP") else None)
+
+    with CheckpointStore("result/genre_transformation/checkpoints/overall_summary.jsonl", "overall_summary", summarizer.prompt_version) as checkpoint:
+        write_results(summarizer.iter_transform(dataset, checkpoint), "result/genre_transformation/overall_summary.jsonl")
+    summarizer.metrics.export("result/genre_transformation/metrics/overall_summary")
@@ -1,14 +1,433 @@
 import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from types import SimpleNamespace
+from typing import Any
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from dsp import LM
+from langchain_core.caches import BaseCache
+from langchain_core.language_models.chat_models import BaseChatModel, merge_chat_generation_chunks
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessageChunk, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk
+from llm_cache import SQLiteLLMCache
 
 load_dotenv()
-def get_llm(model_name = "deepseek-chat"):
+
+_llm_caches = {}
+_client_policies = {}
+
+def get_llm_cache(database_path=None):
+    """
+    One shared cache per database file, so every chain in the process reuses the same connection and statistics.
+    Set LLM_CACHE_PATH to an empty string to disable caching.
+    """
+    if database_path is None:
+        database_path = os.getenv('LLM_CACHE_PATH', '.cache/llm_cache.db')
+    if not database_path:
+        return None
+    if database_path not in _llm_caches:
+        max_bytes = int(os.getenv('LLM_CACHE_MAX_BYTES', 1 << 30))
+        _llm_caches[database_path] = SQLiteLLMCache(database_path, max_bytes=max_bytes)
+    return _llm_caches[database_path]
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at rate_per_minute. reserve() takes the amount immediately and returns how long
+    the caller must wait before using it, so concurrent callers queue up fairly without polling.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AIMDConcurrency:
+    """
+    Additive-increase / multiplicative-decrease limit on requests in flight:
+    every overloaded request (throttled, timed out or 5xx) multiplies the limit by decrease, every success adds
+    about one slot per window of successes, and other failures leave it unchanged.
+    Threads wait on a condition and coroutines on a future, both woken when a slot is released.
+    """
+    def __init__(self, initial=8, minimum=1, maximum=64, decrease=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.slot_freed = threading.Condition(self.lock)
+        self.async_waiters = deque()
+
+    def _try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def try_acquire(self):
+        with self.lock:
+            return self._try_acquire()
+
+    def acquire(self):
+        with self.slot_freed:
+            self.slot_freed.wait_for(self._try_acquire)
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self._try_acquire():
+                    return
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            await future
+
+    def release(self, outcome="success"):
+        with self.lock:
+            self.in_flight -= 1
+            if outcome == "overloaded":
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            elif outcome == "success":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.slot_freed.notify_all()
+            waiters, self.async_waiters = self.async_waiters, deque()
+        # Every waiting coroutine re-checks the limit; the policy may be shared by several event loops.
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass
+
+
+class ClientPolicy:
+    """
+    Request/token rate limits, adaptive concurrency, timeouts and retry backoff shared by every model of one provider.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, initial_concurrency=8, max_concurrency=64,
+                 timeout=120.0, max_retries=6, backoff_base=1.0, backoff_max=60.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AIMDConcurrency(initial_concurrency, maximum=max_concurrency)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    @classmethod
+    def from_env(cls):
+        def env(name, cast, default=None):
+            value = os.getenv(name)
+            return cast(value) if value else default
+        return cls(
+            requests_per_minute=env('LLM_REQUESTS_PER_MINUTE', float),
+            tokens_per_minute=env('LLM_TOKENS_PER_MINUTE', float),
+            initial_concurrency=env('LLM_INITIAL_CONCURRENCY', int, 8),
+            max_concurrency=env('LLM_MAX_CONCURRENCY', int, 64),
+            timeout=env('LLM_TIMEOUT', float, 120.0),
+            max_retries=env('LLM_MAX_RETRIES', int, 6),
+        )
+
+    def reserve(self, tokens):
+        wait = self.requests.reserve(1) if self.requests else 0.0
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def refund(self, reserved_tokens):
+        # A request that failed without an answer gives its whole token reservation back.
+        if self.tokens:
+            self.tokens.refund(reserved_tokens)
+
+    def settle(self, reserved_tokens, used_tokens):
+        # Give back an over-estimate, or charge an under-estimate against the next requests.
+        if self.tokens and used_tokens is not None:
+            self.tokens.refund(reserved_tokens - used_tokens)
+
+    @staticmethod
+    def retryable_errors():
+        # openai is only imported once an error has to be classified, it takes a noticeable share of startup.
+        import openai
+        return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError, TimeoutError, ConnectionError)
+
+    def is_retryable(self, error):
+        return isinstance(error, self.retryable_errors()) or self.is_throttled(error)
+
+    def is_throttled(self, error):
+        import openai
+        return getattr(error, "status_code", None) == 429 or isinstance(error, openai.RateLimitError)
+
+    def outcome(self, error):
+        """
+        "overloaded" for throttling, timeouts and 5xx, which shrink the concurrency limit; "failed" for anything else.
+        """
+        import openai
+        overloaded = (self.is_throttled(error) or (getattr(error, "status_code", None) or 0) >= 500
+                      or isinstance(error, (openai.APITimeoutError, openai.InternalServerError, asyncio.TimeoutError, TimeoutError)))
+        return "overloaded" if overloaded else "failed"
+
+    def backoff(self, attempt):
+        # Full jitter: uniform in [0, min(cap, base * 2^attempt)].
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def get_client_policy(name):
+    if name not in _client_policies:
+        _client_policies[name] = ClientPolicy.from_env()
+    return _client_policies[name]
+
+
+class ResilientChatModel(BaseChatModel):
+    """
+    Wraps a chat model with the ClientPolicy: waits for the rate limits and a concurrency slot,
+    then retries throttled, timed-out or failed requests with jittered exponential backoff.
+    Cache keys and callbacks are the same as for the wrapped model. Streamed calls use the same cache entries:
+    a hit is replayed as a single chunk, and a stream is stored once it completed, never when the caller stopped it early.
+    """
+    model: Any
+    policy: Any
+
+    @property
+    def _llm_type(self):
+        return self.model._llm_type
+
+    @property
+    def _identifying_params(self):
+        return self.model._identifying_params
+
+    def _estimate_tokens(self, messages):
+        # Roughly 4 characters per token; settle() corrects the estimate from the reported usage.
+        prompt_tokens = sum(len(str(message.content)) for message in messages) // 4
+        return prompt_tokens + min(getattr(self.model, "max_tokens", None) or 1024, 1024)
+
+    def _used_tokens(self, result):
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        return usage.get("total_tokens")
+
+    def _stream_cache_key(self, messages, stop, **kwargs):
+        # (prompt, llm_string) exactly as BaseChatModel builds them for invoke, or None without a cache.
+        if not isinstance(self.cache, BaseCache):
+            return None
+        messages = [message.model_copy(update={"id": None}) if getattr(message, "id", None) is not None else message for message in messages]
+        return dumps(messages), self._get_llm_string(stop=stop, **kwargs)
+
+    def _cached_chunk(self, generations):
+        generation = generations[0]
+        message = AIMessageChunk(content=generation.message.content, response_metadata=generation.message.response_metadata)
+        return ChatGenerationChunk(message=message, generation_info=generation.generation_info)
+
+    def _streamed_generation(self, chunks):
+        generation = merge_chat_generation_chunks(chunks)
+        return ChatGeneration(message=message_chunk_to_message(generation.message), generation_info=generation.generation_info)
+
+    def _on_retry(self, run_manager, attempt, error):
+        if run_manager:
+            run_manager.on_retry(SimpleNamespace(attempt_number=attempt + 1, outcome=error))
+
+    async def _aon_retry(self, run_manager, attempt, error):
+        if run_manager:
+            await run_manager.on_retry(SimpleNamespace(attempt_number=attempt + 1, outcome=error))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(self.policy.max_retries + 1):
+            acquired, outcome, error = False, "failed", None
+            try:
+                time.sleep(self.policy.reserve(tokens))
+                self.policy.concurrency.acquire()
+                acquired = True
+                result = self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                outcome = "success"
+            except Exception as e:
+                outcome, error = self.policy.outcome(e), e
+            finally:
+                # Also on KeyboardInterrupt: the policy is shared by the whole process and would lose the slot for good.
+                if acquired:
+                    self.policy.concurrency.release(outcome)
+                if outcome != "success":
+                    self.policy.refund(tokens)
+            if error is None:
+                self.policy.settle(tokens, self._used_tokens(result))
+                return result
+            if attempt == self.policy.max_retries or not self.policy.is_retryable(error):
+                raise error
+            self._on_retry(run_manager, attempt, error)
+            time.sleep(self.policy.backoff(attempt))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(self.policy.max_retries + 1):
+            acquired, outcome, error = False, "failed", None
+            try:
+                await asyncio.sleep(self.policy.reserve(tokens))
+                await self.policy.concurrency.aacquire()
+                acquired = True
+                result = await asyncio.wait_for(self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs), self.policy.timeout)
+                outcome = "success"
+            except Exception as e:
+                outcome, error = self.policy.outcome(e), e
+            finally:
+                # Also on cancellation (a failed gather, a caller timeout, Ctrl-C), which must not leak the slot.
+                if acquired:
+                    self.policy.concurrency.release(outcome)
+                if outcome != "success":
+                    self.policy.refund(tokens)
+            if error is None:
+                self.policy.settle(tokens, self._used_tokens(result))
+                return result
+            if attempt == self.policy.max_retries or not self.policy.is_retryable(error):
+                raise error
+            await self._aon_retry(run_manager, attempt, error)
+            await asyncio.sleep(self.policy.backoff(attempt))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # Retried only until the first chunk arrives: after that the caller has consumed output and the error is raised.
+        # The wrapped model gets no run_manager, the outer stream() already reports every chunk as a new token.
+        cache_key = self._stream_cache_key(messages, stop, **kwargs)
+        cached = self.cache.lookup(*cache_key) if cache_key else None
+        if cached:
+            yield self._cached_chunk(cached)
+            return
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(self.policy.max_retries + 1):
+            acquired, started, outcome, used, error, chunks = False, False, "failed", None, None, []
+            try:
+                time.sleep(self.policy.reserve(tokens))
+                self.policy.concurrency.acquire()
+                acquired = True
+                for chunk in self.model._stream(messages, stop=stop, **kwargs):
+                    started = True
+                    used = (getattr(chunk.message, "usage_metadata", None) or {}).get("total_tokens", used)
+                    chunks.append(chunk)
+                    yield chunk
+                outcome = "success"
+            except GeneratorExit:
+                # The caller stopped consuming early and closed the stream; the request itself went fine.
+                outcome = "success"
+                raise
+            except Exception as e:
+                outcome, error = self.policy.outcome(e), e
+            finally:
+                if acquired:
+                    self.policy.concurrency.release(outcome)
+                if not started and outcome != "success":
+                    self.policy.refund(tokens)
+            if error is None:
+                self.policy.settle(tokens, used)
+                if cache_key and chunks:
+                    self.cache.update(*cache_key, [self._streamed_generation(chunks)])
+                return
+            if started or attempt == self.policy.max_retries or not self.policy.is_retryable(error):
+                raise error
+            self._on_retry(run_manager, attempt, error)
+            time.sleep(self.policy.backoff(attempt))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        cache_key = self._stream_cache_key(messages, stop, **kwargs)
+        cached = await self.cache.alookup(*cache_key) if cache_key else None
+        if cached:
+            yield self._cached_chunk(cached)
+            return
+        tokens = self._estimate_tokens(messages)
+        for attempt in range(self.policy.max_retries + 1):
+            acquired, started, outcome, used, error, chunks = False, False, "failed", None, None, []
+            stream = self.model._astream(messages, stop=stop, **kwargs)
+            try:
+                await asyncio.sleep(self.policy.reserve(tokens))
+                await self.policy.concurrency.aacquire()
+                acquired = True
+                # The timeout bounds the time to first token; the provider client's own timeout covers the gaps after it.
+                chunk = await asyncio.wait_for(stream.__anext__(), self.policy.timeout)
+                while True:
+                    started = True
+                    used = (getattr(chunk.message, "usage_metadata", None) or {}).get("total_tokens", used)
+                    chunks.append(chunk)
+                    yield chunk
+                    chunk = await stream.__anext__()
+            except StopAsyncIteration:
+                outcome = "success"
+            except GeneratorExit:
+                outcome = "success"
+                raise
+            except Exception as e:
+                outcome, error = self.policy.outcome(e), e
+            finally:
+                await stream.aclose()
+                if acquired:
+                    self.policy.concurrency.release(outcome)
+                if not started and outcome != "success":
+                    self.policy.refund(tokens)
+            if error is None:
+                self.policy.settle(tokens, used)
+                if cache_key and chunks:
+                    await self.cache.aupdate(*cache_key, [self._streamed_generation(chunks)])
+                return
+            if started or attempt == self.policy.max_retries or not self.policy.is_retryable(error):
+                raise error
+            await self._aon_retry(run_manager, attempt, error)
+            await asyncio.sleep(self.policy.backoff(attempt))
+
+
+def get_llm(model_name = None, rate_limiter=None, cache_path=None, max_tokens=4096):
+    if model_name is None:
+        model_name = os.getenv('LLM_MODEL', 'deepseek-chat')
+    # Provider clients are imported on first use, so scripts only pay for the backend they run.
     if (model_name == "deepseek-chat"):
-        return ChatOpenAI(
+        from langchain_openai import ChatOpenAI
+        model = ChatOpenAI(
             model='deepseek-chat', 
             openai_api_key=os.getenv('DEEPSEEK_API_KEY'), 
             openai_api_base='https://api.deepseek.com',
-            max_tokens=4096
-        )
\ No newline at end of file
+            max_tokens=max_tokens,
+            # Retries and timeouts are handled by ResilientChatModel.
+            max_retries=0,
+            timeout=get_client_policy(model_name).timeout,
+            # Report token usage on the last chunk of streamed completions too.
+            stream_usage=True
+        )
+    elif (model_name == "fake"):
+        # Offline deterministic model for benchmarks; only cached when a cache path is given explicitly.
+        if cache_path is None:
+            cache_path = os.getenv('FAKE_LLM_CACHE_PATH', '')
+        from fake_llm import FakeChatModel
+        model = FakeChatModel(
+            latency_mean=float(os.getenv('FAKE_LLM_LATENCY', 0.0)),
+            latency_std=float(os.getenv('FAKE_LLM_LATENCY_STD', 0.0)),
+            error_rate=float(os.getenv('FAKE_LLM_ERROR_RATE', 0.0)),
+            token_latency=float(os.getenv('FAKE_LLM_TOKEN_LATENCY', 0.0)),
+            max_tokens=max_tokens
+        )
+    else:
+        raise ValueError(f"Unknown model_name: {model_name}")
+    return ResilientChatModel(
+        model=model,
+        policy=get_client_policy(model_name),
+        rate_limiter=rate_limiter,
+        cache=get_llm_cache(cache_path)
+    )
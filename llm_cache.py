@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+
+
+class SQLiteLLMCache(BaseCache):
+    """
+    Persistent LLM response cache keyed on (llm_string, rendered prompt).
+    llm_string already encodes the model name and its parameters, so changing either misses the cache.
+    Least recently used entries are evicted once the stored responses exceed max_bytes.
+    """
+    def __init__(self, database_path=".cache/llm_cache.db", max_bytes=1 << 30):
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        self.database_path = database_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(database_path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                llm_string TEXT,
+                value TEXT,
+                size INTEGER,
+                last_access REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+        self.conn.commit()
+        self.total_bytes = self._stored_bytes()
+
+    def _key(self, prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def _stored_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    def lookup(self, prompt, llm_string):
+        key = self._key(prompt, llm_string)
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        generations = [loads(generation) for generation in json.loads(row[0])]
+        # Flag cache-served answers, so metrics can tell them from paid calls (their usage is the original call's).
+        for generation in generations:
+            generation.generation_info = {**(generation.generation_info or {}), "cache_hit": True}
+        return generations
+
+    def update(self, prompt, llm_string, return_val):
+        value = json.dumps([dumps(generation) for generation in return_val])
+        size = len(value.encode("utf-8"))
+        key = self._key(prompt, llm_string)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, llm_string, value, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, llm_string, value, size, time.time())
+            )
+            self.conn.commit()
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other processes may share the database, so re-read the real size before evicting.
+        self.total_bytes = self._stored_bytes()
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+        self.conn.commit()
+
+    def clear(self, **kwargs):
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.conn.commit()
+            self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": self.total_bytes,
+        }
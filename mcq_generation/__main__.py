@@ -0,0 +1,70 @@
+"""
+python -m mcq_generation
+"""
+import os
+import sys
+import random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from mcq_generation.quiz import (NUM_THREADS, SEED, configure_dspy, load_hotpotqa, build_quiz_generator_with_assertions,
+                                 overall_metric, evaluate_metrics, timed_stage, print_stage_times)
+
+"""
+Earlier experiments, with quiz_generator = build_quiz_generator() and metrics from mcq_generation.quiz:
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset, num_threads=1, display_progress=True, display_table=5)
+    evaluate(quiz_generator)
+    
+example = devset[67]
+quiz_choices = quiz_generator(question=example.question, answer = example.answer)
+print(f'Generated Quiz Choices: ', quiz_choices.choices)
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset[67:68], num_threads=1, display_progress=True, display_table=5)
+    evaluate(quiz_generator)
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset, num_threads=1, display_progress=True, display_table=5)
+    evaluate(quiz_generator_with_assertions)
+    
+example = devset[67]
+quiz_choices = quiz_generator_with_assertions(question=example.question, answer = example.answer)
+print(f'Generated Quiz Choices: ', quiz_choices.choices)
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset[67:68], num_threads=1, display_progress=True, display_table=30)
+    evaluate(quiz_generator_with_assertions)
+
+    
+teleprompter = BootstrapFewShotWithRandomSearch(metric = overall_metric, max_bootstrapped_demos=2, num_candidate_programs=6)
+compiled_quiz_generator = teleprompter.compile(student = quiz_generator, teacher = quiz_generator, trainset=trainset, valset=devset[:100])
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset, num_threads=1, display_progress=True, display_table=5)
+    evaluate(compiled_quiz_generator)
+    
+    
+teleprompter = BootstrapFewShotWithRandomSearch(metric = overall_metric, max_bootstrapped_demos=2, num_candidate_programs=6)
+compiled_with_assertions_quiz_generator = teleprompter.compile(student=quiz_generator, teacher = quiz_generator_with_assertions, trainset=trainset, valset=devset[:100])
+
+for metric in metrics:
+    evaluate = Evaluate(metric=metric, devset=devset, num_threads=1, display_progress=True, display_table=5)
+    evaluate(compiled_with_assertions_quiz_generator)
+    
+"""
+
+if __name__ == "__main__":
+    from dspy.teleprompt import BootstrapFewShotWithRandomSearch
+
+    random.seed(SEED)
+    configure_dspy()
+    trainset, devset = load_hotpotqa()
+    quiz_generator_with_assertions = build_quiz_generator_with_assertions()
+
+    teleprompter = BootstrapFewShotWithRandomSearch(metric = overall_metric, max_bootstrapped_demos=2, num_candidate_programs=6, num_threads=NUM_THREADS)
+    with timed_stage("compile"):
+        compiled_quiz_generator_with_assertions = teleprompter.compile(student=quiz_generator_with_assertions, teacher = quiz_generator_with_assertions, trainset=trainset, valset=devset[:100])
+
+    evaluate_metrics(compiled_quiz_generator_with_assertions, devset, "evaluate_compiled_with_assertions")
+
+    print_stage_times()
@@ -0,0 +1,247 @@
+"""
+MCQ distractor generation as an importable library: signatures, modules, metrics and evaluation helpers.
+Importing it configures nothing; the retriever, LM and datasets are set up on first use, and the
+end-to-end run lives in mcq_generation/__main__.py (python -m mcq_generation).
+"""
+import os
+import sys
+import time
+import json
+import contextlib
+import threading
+import dspy
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Evaluation and candidate-program search run on NUM_THREADS threads; SEED pins every source of randomness we control.
+NUM_THREADS = int(os.getenv("NUM_THREADS", 8))
+SEED = int(os.getenv("SEED", 0))
+
+stage_times = {}
+
+@contextlib.contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_times[name] = stage_times.get(name, 0.0) + time.perf_counter() - start
+
+def print_stage_times():
+    print("Wall-clock time per stage:")
+    for name, seconds in stage_times.items():
+        print(f"  {name}: {seconds:.1f}s")
+
+def configure_retriever(retriever=None):
+    """
+    MCQ_RETRIEVER=bm25 (default) uses the local BM25 index in MCQ_INDEX_DIR, building it from MCQ_CORPUS on first use;
+    MCQ_RETRIEVER=colbert uses the remote ColBERTv2 wiki17 abstracts server.
+    """
+    if retriever is None:
+        retriever = os.getenv("MCQ_RETRIEVER", "bm25")
+    if retriever == "colbert":
+        rm = dspy.ColBERTv2(url='http://20.102.90.50:2017/wiki17_abstracts')
+    elif retriever == "bm25":
+        from mcq_generation.retrieval import BM25Retriever, build_corpus_index
+        index_dir = os.getenv("MCQ_INDEX_DIR", ".cache/bm25_wikibooks")
+        if not os.path.exists(os.path.join(index_dir, "meta.json")):
+            with timed_stage("build_index"):
+                build_corpus_index(os.getenv("MCQ_CORPUS", "./data/wikibooks.jsonl"), index_dir)
+        rm = BM25Retriever(index_dir)
+    else:
+        raise ValueError(f"Unknown retriever: {retriever}")
+    dspy.settings.configure(rm=rm)
+    return rm
+
+def configure_dspy(model_name=None):
+    """
+    MCQ_MODEL=fake runs fully offline on the deterministic FakeDSPyLM, without a retriever.
+    """
+    if model_name is None:
+        model_name = os.getenv("MCQ_MODEL", "gpt-3.5-turbo-0613")
+    if model_name == "fake":
+        from fake_dspy import FakeDSPyLM
+        lm = FakeDSPyLM(
+            latency_mean=float(os.getenv("FAKE_LLM_LATENCY", 0.0)),
+            latency_std=float(os.getenv("FAKE_LLM_LATENCY_STD", 0.0)),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", 0.0)),
+            seed=SEED
+        )
+    else:
+        configure_retriever()
+        lm = dspy.OpenAI(model=model_name, max_tokens=500)
+    dspy.settings.configure(lm=lm, trace=[], temperature=0.7)
+    return lm
+
+def load_hotpotqa():
+    from dspy.datasets import HotPotQA
+
+    with timed_stage("load_dataset"):
+        dataset = HotPotQA(train_seed=1, train_size=300, eval_seed=2023, dev_size=300, test_size=0, keep_details=True)
+        trainset = [x.with_inputs('question', 'answer') for x in dataset.train]
+        devset = [x.with_inputs('question', 'answer') for x in dataset.dev]
+    return trainset, devset
+
+class GenerateAnswerChoices(dspy.Signature):
+    """Generate answer choices in JSON format that include the correct answer and plausible distractors for the specified question."""
+    question = dspy.InputField()
+    correct_answer = dspy.InputField()
+    number_of_choices = dspy.InputField()
+    answer_choices = dspy.OutputField(desc='JSON key-value pairs')
+
+class QuizAnswerGenerator(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.generate_choices = dspy.ChainOfThought(GenerateAnswerChoices)
+
+    def forward(self, question, answer):
+        choices = self.generate_choices(question=question, correct_answer=answer, number_of_choices=number_of_choices).answer_choices
+        return dspy.Prediction(choices = choices)
+
+number_of_choices = '4'
+
+
+def format_checker(choice_string):
+    try:
+        choices = json.loads(choice_string)
+        if isinstance(choices, dict) and all(isinstance(key, str) and isinstance(value, str) for key, value in choices.items()):
+            return True
+    except json.JSONDecodeError:
+        return False
+
+    return False
+
+def is_correct_answer_included(correct_answer, generated_choices):
+    try:
+        choices_dict = json.loads(generated_choices)
+        return correct_answer in choices_dict.values()
+    except json.JSONDecodeError:
+        return False
+
+def is_plausibility_yes(assessment_answer):
+    """Check if the first word of the assessment answer is 'yes'."""
+    return assessment_answer.split()[0].lower() == 'yes'
+    
+class AssessQuizChoices(dspy.Signature):
+    """Assess the quality of quiz answer choices along specified dimensions."""
+    
+    question = dspy.InputField()
+    answer_choices = dspy.InputField()
+    assessment_question = dspy.InputField()
+    assessment_answer = dspy.OutputField(desc="Yes or No")
+    
+PLAUSIBILITY_QUESTION = "Are the distractors in the answer choices plausible and not easily identifiable as incorrect?"
+
+plausibility_cache = {}
+plausibility_cache_lock = threading.Lock()
+
+def normalize_choices(choice_string):
+    try:
+        return json.dumps(json.loads(choice_string), sort_keys=True, ensure_ascii=False)
+    except (json.JSONDecodeError, TypeError):
+        return " ".join(str(choice_string).split())
+
+def judge_plausibility(question, answer_choices):
+    """
+    Memoized AssessQuizChoices call shared by the metrics and the assertion module,
+    keyed on the whitespace-normalized question and the canonical JSON of the choices.
+    """
+    key = (" ".join(question.split()), normalize_choices(answer_choices))
+    with plausibility_cache_lock:
+        if key in plausibility_cache:
+            return plausibility_cache[key]
+    plausibility_assessment = dspy.Predict(AssessQuizChoices)(question=question, answer_choices=answer_choices, assessment_question=PLAUSIBILITY_QUESTION)
+    result = is_plausibility_yes(plausibility_assessment.assessment_answer)
+    with plausibility_cache_lock:
+        plausibility_cache[key] = result
+    return result
+
+def format_valid_metric(gold, pred, trace=None):
+    generated_choices = pred.choices
+    format_valid = format_checker(generated_choices)
+    score = format_valid
+    return score
+
+def is_correct_metric(gold, pred, trace=None):
+    correct_answer, generated_choices = gold.answer, pred.choices
+    correct_included = is_correct_answer_included(correct_answer, generated_choices)
+    score = correct_included
+    return score
+
+def plausibility_metric(gold, pred, trace=None):
+    question, generated_choices = gold.question, pred.choices
+    score = judge_plausibility(question, generated_choices)
+    return score
+
+def overall_metric(gold, pred, trace=None):
+    question, correct_answer, generated_choices = gold.question, gold.answer, pred.choices
+    format_valid = format_checker(generated_choices)
+    correct_included = is_correct_answer_included(correct_answer, generated_choices)
+    if not (correct_included and format_valid):
+        return 0
+    plausibility_result = judge_plausibility(question, generated_choices)
+    score = (format_valid + correct_included + plausibility_result) / 3.0
+    return score
+
+class MetricSuite:
+    """
+    Scores every metric from a single pass over each prediction.
+    Used as the Evaluate metric, it returns overall_metric and records the other scores on the side.
+    """
+    def __init__(self, metrics):
+        self.__name__ = "overall_metric"  # Evaluate labels its table with the metric name
+        self.metrics = metrics
+        self.scores = {metric.__name__: [] for metric in metrics}
+        self.lock = threading.Lock()
+
+    def __call__(self, gold, pred, trace=None):
+        scores = {metric.__name__: metric(gold, pred, trace) for metric in self.metrics}
+        with self.lock:
+            for name, score in scores.items():
+                self.scores[name].append(float(score))
+        return scores["overall_metric"]
+
+    def summary(self, total=None):
+        """
+        Average scores in percent over total examples. Evaluate never calls the metric for examples whose program
+        raised and scores them 0, so pass len(devset) to get the same averages as one Evaluate run per metric.
+        """
+        return {name: 100 * sum(scores) / (total or len(scores)) if total or scores else 0.0 for name, scores in self.scores.items()}
+
+    
+class QuizAnswerGeneratorWithAssertions(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.generate_choices = dspy.ChainOfThought(GenerateAnswerChoices)
+
+    def forward(self, question, answer):
+        choice_string = self.generate_choices(question=question, correct_answer=answer, number_of_choices=number_of_choices).answer_choices
+        dspy.Suggest(format_checker(choice_string), "The format of the answer choices should be in JSON format. Please revise accordingly.", target_module=GenerateAnswerChoices)
+        dspy.Suggest(is_correct_answer_included(answer, choice_string), "The answer choices do not include the correct answer to the question. Please revise accordingly.", target_module=GenerateAnswerChoices)
+        dspy.Suggest(judge_plausibility(question, choice_string), "The answer choices are not plausible distractors or are too easily identifiable as incorrect. Please revise to provide more challenging and plausible distractors.", target_module=GenerateAnswerChoices)
+        return dspy.Prediction(choices = choice_string)
+
+def build_quiz_generator():
+    return QuizAnswerGenerator()
+
+def build_quiz_generator_with_assertions():
+    from dspy.predict import Retry
+    from dspy.primitives.assertions import assert_transform_module, backtrack_handler
+
+    return assert_transform_module(QuizAnswerGeneratorWithAssertions().map_named_predictors(Retry), backtrack_handler)
+
+
+metrics = [format_valid_metric, is_correct_metric, plausibility_metric, overall_metric]
+
+def evaluate_metrics(program, devset, stage_name, display_table=5):
+    """
+    Evaluate program with every metric in one pass on NUM_THREADS threads; Evaluate keeps results in devset order.
+    """
+    from dspy.evaluate.evaluate import Evaluate
+
+    suite = MetricSuite(metrics)
+    with timed_stage(stage_name):
+        evaluate = Evaluate(metric=suite, devset=devset, num_threads=NUM_THREADS, display_progress=True, display_table=display_table)
+        evaluate(program)
+    scores = suite.summary(len(devset))
+    print(f"{stage_name}:", ", ".join(f"{name}={score:.1f}" for name, score in scores.items()))
+    return scores
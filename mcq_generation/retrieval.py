@@ -0,0 +1,180 @@
+"""
+Offline BM25 retriever that plugs into DSPy in place of the remote ColBERTv2 server.
+
+    python -m mcq_generation.retrieval build --corpus data/wikibooks.jsonl --index-dir .cache/bm25_wikibooks
+    python -m mcq_generation.retrieval search --index-dir .cache/bm25_wikibooks "Who founded the Roman Empire?"
+
+The index directory holds the postings as .npy arrays, loaded memory-mapped, plus the passages in a JSONL file
+read by byte offset, so opening an index costs little more than reading its vocabulary.
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+STOPWORDS = set("a an and are as at be by for from has have in is it its of on or that the this to was were which with".split())
+
+
+def tokenize(text):
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+
+def split_passages(text, passage_words=150):
+    """
+    Split a document into passages of about passage_words words, keeping paragraphs together where possible.
+    """
+    passages, current, length = [], [], 0
+    for paragraph in text.split("\n"):
+        words = paragraph.split()
+        if not words:
+            continue
+        if current and length + len(words) > passage_words:
+            passages.append(" ".join(current))
+            current, length = [], 0
+        for start in range(0, len(words), passage_words):
+            chunk = words[start:start + passage_words]
+            if len(chunk) == passage_words:
+                passages.append(" ".join(chunk))
+            else:
+                current.extend(chunk)
+                length += len(chunk)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+def build_index(passages, index_dir, k1=1.5, b=0.75):
+    """
+    Build a BM25 index over an iterable of passage strings and write it to index_dir.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    vocabulary = {}
+    postings = []  # term id -> [doc ids, term frequencies]
+    doc_lengths = []
+    offsets = []
+
+    with open(os.path.join(index_dir, "passages.jsonl"), "wb") as f:
+        for doc_id, passage in enumerate(passages):
+            offsets.append(f.tell())
+            f.write((json.dumps(passage, ensure_ascii=False) + "\n").encode("utf-8"))
+            tokens = tokenize(passage)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                if term_id == len(postings):
+                    postings.append(([], []))
+                postings[term_id][0].append(doc_id)
+                postings[term_id][1].append(count)
+
+    term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    term_offsets[1:] = np.cumsum([len(docs) for docs, _ in postings])
+    np.save(os.path.join(index_dir, "term_offsets.npy"), term_offsets)
+    np.save(os.path.join(index_dir, "postings_docs.npy"), np.fromiter((d for docs, _ in postings for d in docs), dtype=np.int32, count=term_offsets[-1]))
+    np.save(os.path.join(index_dir, "postings_tfs.npy"), np.fromiter((c for _, counts in postings for c in counts), dtype=np.float32, count=term_offsets[-1]))
+    np.save(os.path.join(index_dir, "doc_lengths.npy"), np.asarray(doc_lengths, dtype=np.float32))
+    np.save(os.path.join(index_dir, "passage_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"k1": k1, "b": b, "num_docs": len(doc_lengths), "vocabulary": vocabulary}, f, ensure_ascii=False)
+    return len(doc_lengths)
+
+
+def build_corpus_index(corpus_path, index_dir, text_key="text", passage_words=150):
+    from data_io import stream_documents
+
+    passages = (passage for data in stream_documents(corpus_path, text_key=text_key) for passage in split_passages(data.page_content, passage_words))
+    return build_index(passages, index_dir)
+
+
+class BM25Retriever:
+    """
+    BM25 over a prebuilt index, callable like dspy.ColBERTv2: rm(query, k) returns the top k passages as
+    dotdicts with long_text, score and pid. A list of queries is fused by summing scores, and
+    batch_search ranks several queries independently in one call.
+    """
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.k1, self.b = meta["k1"], meta["b"]
+        self.vocabulary = meta["vocabulary"]
+        load = lambda name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+        self.term_offsets = load("term_offsets")
+        self.postings_docs = load("postings_docs")
+        self.postings_tfs = load("postings_tfs")
+        self.passage_offsets = load("passage_offsets")
+        doc_lengths = np.asarray(load("doc_lengths"))
+        self.num_docs = len(doc_lengths)
+        # Per-document length normalization k1 * (1 - b + b * dl / avgdl), precomputed once.
+        self.length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(doc_lengths.mean(), 1.0)) if self.num_docs else doc_lengths
+        # Passages are read with pread, so concurrent evaluation threads can share one file descriptor.
+        self.passages_fd = os.open(os.path.join(index_dir, "passages.jsonl"), os.O_RDONLY)
+        self.passages_size = os.fstat(self.passages_fd).st_size
+
+    def scores(self, query):
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for token in set(tokenize(query)):
+            term_id = self.vocabulary.get(token)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            docs, tfs = self.postings_docs[start:end], self.postings_tfs[start:end]
+            idf = np.log(1 + (self.num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+        return scores
+
+    def top_k(self, scores, k):
+        k = min(k, self.num_docs)
+        if k <= 0:
+            return []
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return [int(pid) for pid in candidates[np.argsort(-scores[candidates])] if scores[pid] > 0]
+
+    def passage(self, pid):
+        start = int(self.passage_offsets[pid])
+        end = int(self.passage_offsets[pid + 1]) if pid + 1 < self.num_docs else self.passages_size
+        return json.loads(os.pread(self.passages_fd, end - start, start))
+
+    def results(self, scores, k):
+        from dsp.utils import dotdict
+
+        return [dotdict(long_text=self.passage(pid), score=float(scores[pid]), pid=pid) for pid in self.top_k(scores, k)]
+
+    def batch_search(self, queries, k=3):
+        return [self.results(self.scores(query), k) for query in queries]
+
+    def __call__(self, query_or_queries, k=3, **kwargs):
+        queries = [query_or_queries] if isinstance(query_or_queries, str) else list(query_or_queries)
+        scores = sum((self.scores(query) for query in queries), np.zeros(self.num_docs, dtype=np.float32))
+        return self.results(scores, k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build")
+    build.add_argument("--corpus", default="./data/wikibooks.jsonl")
+    build.add_argument("--text-key", default="text")
+    build.add_argument("--index-dir", default=".cache/bm25_wikibooks")
+    build.add_argument("--passage-words", type=int, default=150)
+    search = subparsers.add_parser("search")
+    search.add_argument("--index-dir", default=".cache/bm25_wikibooks")
+    search.add_argument("-k", type=int, default=3)
+    search.add_argument("query", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_corpus_index(args.corpus, args.index_dir, args.text_key, args.passage_words)
+        print(f"Indexed {count} passages into {args.index_dir}")
+    else:
+        retriever = BM25Retriever(args.index_dir)
+        for pid in retriever.top_k(retriever.scores(" ".join(args.query)), args.k):
+            print(pid, retriever.passage(pid)[:200])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf")]
+
+# USD per million (prompt, cached prompt, completion) tokens, used for cost estimates only.
+PRICES_PER_MILLION = {
+    "deepseek-chat": (0.27, 0.07, 1.10),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "fake": (0.0, 0.0, 0.0),
+}
+
+# For streams closed before the provider reported usage, tokens are estimated from the text length.
+CHARS_PER_TOKEN = 4
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def to_dict(self):
+        cumulative, total = [], 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {"count": self.count, "sum": self.sum, "buckets": {str(bound): c for bound, c in zip(self.buckets, cumulative)}}
+
+
+class StageCallbackHandler(BaseCallbackHandler):
+    """
+    Callback handler bound to one stage (chain) of a transformer; reports into a shared MetricsRecorder.
+    """
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+        self.chain_starts = {}
+        self.seen_runs = set()
+        self.prompt_chars = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        # Only the outermost run of this stage is timed; nested prompt/llm/parser runs share the callbacks.
+        if parent_run_id not in self.seen_runs:
+            self.chain_starts[run_id] = time.perf_counter()
+        self.seen_runs.add(run_id)
+
+    def _finish_chain(self, run_id, failed):
+        self.seen_runs.discard(run_id)
+        start = self.chain_starts.pop(run_id, None)
+        if start is not None:
+            self.recorder.observe_latency(self.stage, time.perf_counter() - start, failed)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish_chain(run_id, failed=False)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        # GeneratorExit means the consumer closed a stream early (see streaming.py), not that the stage failed.
+        self._finish_chain(run_id, failed=not isinstance(error, GeneratorExit))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.prompt_chars[run_id] = sum(len(str(message.content)) for prompt in messages for message in prompt)
+
+    def _usage(self, response):
+        llm_output = response.llm_output or {}
+        model_name = llm_output.get("model_name")
+        prompt_tokens = completion_tokens = cached_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+                    cached_tokens += (usage.get("input_token_details") or {}).get("cache_read", 0) or 0
+        if not prompt_tokens and not completion_tokens:
+            token_usage = llm_output.get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        if not cached_tokens:
+            # DeepSeek reports prefix cache hits as prompt_cache_hit_tokens, OpenAI under prompt_tokens_details.
+            token_usage = llm_output.get("token_usage") or {}
+            cached_tokens = token_usage.get("prompt_cache_hit_tokens") or (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return model_name, prompt_tokens, completion_tokens, cached_tokens
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.prompt_chars.pop(run_id, None)
+        if any((generation.generation_info or {}).get("cache_hit") for generations in response.generations for generation in generations):
+            # Served by SQLiteLLMCache: nothing was sent to the provider, so no tokens and no cost.
+            self.recorder.increment(f"{self.stage}_cache_hits")
+            return
+        self.recorder.add_tokens(self.stage, *self._usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        prompt_chars = self.prompt_chars.pop(run_id, 0)
+        if not isinstance(error, GeneratorExit):
+            self.recorder.increment(f"{self.stage}_llm_errors")
+            return
+        self.recorder.increment(f"{self.stage}_streams_closed")
+        response = kwargs.get("response")
+        model_name, prompt_tokens, completion_tokens, cached_tokens = self._usage(response) if response else (None, 0, 0, 0)
+        if not prompt_tokens and not completion_tokens:
+            # Stopped early (see streaming.py) before the final usage chunk: the prompt and the tokens streamed so far
+            # were still paid for.
+            streamed_chars = sum(len(generation.text) for generations in (response.generations if response else []) for generation in generations)
+            prompt_tokens, completion_tokens = prompt_chars // CHARS_PER_TOKEN, streamed_chars // CHARS_PER_TOKEN
+            self.recorder.increment(f"{self.stage}_estimated_token_calls")
+        self.recorder.add_tokens(self.stage, model_name, prompt_tokens, completion_tokens, cached_tokens)
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        self.recorder.increment(f"{self.stage}_retries")
+
+
+class MetricsRecorder:
+    """
+    Per-stage latency histograms, token counters, retry/error counts and cost estimates for one transformer.
+    Attach handler(stage) to a chain with chain.with_config(callbacks=[...]) and call export() at the end of a run.
+    """
+    def __init__(self, default_model="deepseek-chat"):
+        self.default_model = default_model
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.tokens = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def handler(self, stage):
+        return StageCallbackHandler(self, stage)
+
+    def observe_latency(self, stage, seconds, failed=False):
+        with self.lock:
+            self.latencies.setdefault(stage, Histogram()).observe(seconds)
+            if failed:
+                self.counters[f"{stage}_failures"] = self.counters.get(f"{stage}_failures", 0) + 1
+
+    def add_tokens(self, stage, model_name, prompt_tokens, completion_tokens, cached_tokens=0):
+        model_name = model_name or self.default_model
+        prompt_price, cached_price, completion_price = next((price for name, price in PRICES_PER_MILLION.items() if model_name.startswith(name)), (0.0, 0.0, 0.0))
+        cost = ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price + completion_tokens * completion_price) / 1e6
+        with self.lock:
+            tokens = self.tokens.setdefault(stage, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost_usd": 0.0})
+            tokens["calls"] += 1
+            tokens["prompt_tokens"] += prompt_tokens
+            tokens["completion_tokens"] += completion_tokens
+            tokens["cached_tokens"] += cached_tokens
+            tokens["cost_usd"] += cost
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            prompt_tokens = sum(tokens["prompt_tokens"] for tokens in self.tokens.values())
+            cached_tokens = sum(tokens["cached_tokens"] for tokens in self.tokens.values())
+            return {
+                "wall_seconds": time.time() - self.started,
+                "latency_seconds": {stage: histogram.to_dict() for stage, histogram in self.latencies.items()},
+                "tokens": {stage: dict(tokens) for stage, tokens in self.tokens.items()},
+                "counters": dict(self.counters),
+                "total_cost_usd": sum(tokens["cost_usd"] for tokens in self.tokens.values()),
+                "prompt_cache_hit_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            }
+
+    def to_prometheus(self, prefix="lamada"):
+        summary = self.summary()
+        lines = [f"# TYPE {prefix}_stage_latency_seconds histogram"]
+        for stage, histogram in summary["latency_seconds"].items():
+            for bound, count in histogram["buckets"].items():
+                le = "+Inf" if bound == "inf" else bound
+                lines.append(f'{prefix}_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+        for field in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"):
+            lines.append(f"# TYPE {prefix}_stage_{field}_total counter")
+            for stage, tokens in summary["tokens"].items():
+                lines.append(f'{prefix}_stage_{field}_total{{stage="{stage}"}} {tokens[field]}')
+        lines.append(f"# TYPE {prefix}_events_total counter")
+        for name, value in summary["counters"].items():
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, save_prefix):
+        """
+        Write save_prefix.json (summary) and save_prefix.prom (Prometheus text format).
+        """
+        os.makedirs(os.path.dirname(save_prefix) or ".", exist_ok=True)
+        with open(f"{save_prefix}.json", "w") as f:
+            json.dump(self.summary(), f, indent=4)
+        with open(f"{save_prefix}.prom", "w") as f:
+            f.write(self.to_prometheus())
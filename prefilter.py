@@ -0,0 +1,39 @@
+import re
+
+DEFAULT_BOILERPLATE_PATTERNS = [
+    r"^jump to (navigation|search)",
+    r"^navigation menu$",
+    r"^retrieved from ",
+    r"^categories?:",
+    r"^this page (was last edited|has been accessed)",
+    r"^(print|pdf) version",
+    r"^#?redirect\b",
+    r"^(additional information|external links|see also|references)\b",
+]
+
+
+class LocalPrefilter:
+    """
+    Cheap local checks that reject obvious no-go documents before any LLM call:
+    too little content once navigation boilerplate is stripped, too long, or mostly non-English text.
+    """
+    def __init__(self, min_chars=200, max_chars=None, min_ascii_letter_ratio=0.8, boilerplate_patterns=DEFAULT_BOILERPLATE_PATTERNS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.min_ascii_letter_ratio = min_ascii_letter_ratio
+        self.boilerplate = re.compile("|".join(f"(?:{pattern})" for pattern in boilerplate_patterns), re.IGNORECASE)
+
+    def strip_boilerplate(self, text):
+        return "\n".join(line for line in text.splitlines() if not self.boilerplate.search(line.strip()))
+
+    def __call__(self, text):
+        content = self.strip_boilerplate(text)
+        if len(content.strip()) < self.min_chars:
+            return False
+        if self.max_chars and len(text) > self.max_chars:
+            return False
+        letters = [c for c in content if c.isalpha()]
+        if not letters:
+            return False
+        ascii_letters = sum(1 for c in letters if c.isascii())
+        return ascii_letters / len(letters) >= self.min_ascii_letter_ratio
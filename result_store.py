@@ -0,0 +1,273 @@
+"""
+Compact storage for transformation results.
+
+Records are written to <name>.records.jsonl with original_text replaced by original_text_id, and every source text
+is written once to <name>.texts.jsonl as {"id": ..., "text": ...}, instead of being repeated in every record.
+The records file has its own suffix so that it never shares a path with the plain <name>.jsonl output, since
+resuming a run with a different RESULT_STORE setting would otherwise mix both record formats in one file.
+With compression="zstd" both files are zstd-compressed (.jsonl.zst, needs the zstandard package), and
+export_columnar writes Parquet or Arrow IPC files (needs pyarrow) that training jobs can memory-map and column-scan.
+"""
+import io
+import os
+import json
+import hashlib
+import threading
+
+COMPRESSION_SUFFIXES = {None: "", "zstd": ".zst"}
+RECORDS_SUFFIX = ".records.jsonl"
+
+
+def text_id(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd-compressed results need the zstandard package: pip install zstandard") from e
+    return zstandard
+
+
+def complete_frames_end(path, chunk_size=1 << 20):
+    """
+    Offset just past the last complete zstd frame of path.
+    """
+    zstandard = _zstandard()
+    size = os.path.getsize(path)
+    end = 0
+    with open(path, "rb") as f:
+        while end < size:
+            f.seek(end)
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+            consumed = 0
+            while not decompressor.eof:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return end
+                try:
+                    decompressor.decompress(chunk)
+                except zstandard.ZstdError:
+                    return end
+                consumed += len(chunk)
+            end += consumed - len(decompressor.unused_data)
+    return end
+
+
+def open_text(path, mode="r", level=10):
+    """
+    Open a text file for "r", "w" or "a", transparently (de)compressing paths ending in .zst.
+    Appending to a .zst file adds a new zstd frame, which readers decode across. A crashed writer leaves an
+    unterminated frame behind, which would make the whole file unreadable once appended to, so it is cut off first;
+    flush_text ends a frame, which keeps everything flushed before the crash.
+    """
+    if not path.endswith(".zst"):
+        return open(path, mode, encoding="utf-8")
+    zstandard = _zstandard()
+    if mode == "r":
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    if mode == "a" and os.path.exists(path):
+        end = complete_frames_end(path)
+        if end < os.path.getsize(path):
+            os.truncate(path, end)
+    writer = zstandard.ZstdCompressor(level=level).stream_writer(open(path, mode + "b"), closefd=True)
+    return io.TextIOWrapper(writer, encoding="utf-8")
+
+
+def flush_text(f, path):
+    """
+    Flush a file from open_text. For .zst files the current zstd frame is ended, so the data survives a crash.
+    """
+    f.flush()
+    if path.endswith(".zst"):
+        f.buffer.flush(_zstandard().FLUSH_FRAME)
+
+
+def iter_jsonl(path):
+    with open_text(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TextStore:
+    """
+    Append-only file of source texts keyed by text_id, each text written at most once.
+    One TextStore can be shared by the ResultStores of several transformers, also across threads.
+    """
+    def __init__(self, save_path, compression=None):
+        self.save_path = save_path + COMPRESSION_SUFFIXES[compression]
+        os.makedirs(os.path.dirname(self.save_path) or ".", exist_ok=True)
+        # Opened first: appending cuts off what a crashed run did not flush, whose ids must not be kept.
+        self.file = open_text(self.save_path, "a")
+        self.ids = {entry["id"] for entry in iter_jsonl(self.save_path)}
+        self.lock = threading.Lock()
+
+    def add(self, text):
+        key = text_id(text)
+        with self.lock:
+            if key not in self.ids:
+                self.ids.add(key)
+                self.file.write(json.dumps({"id": key, "text": text}, ensure_ascii=False) + "\n")
+        return key
+
+    def flush(self):
+        with self.lock:
+            flush_text(self.file, self.save_path)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ResultStore:
+    """
+    Drop-in replacement for JsonlWriter that stores each original_text once in a TextStore.
+    Plain files are flushed after every record like JsonlWriter; compressed ones every flush_every records,
+    so a crash loses at most that many records.
+    """
+    def __init__(self, save_path, compression=None, texts=None, mode="a", flush_every=64):
+        if save_path.endswith(".jsonl"):
+            save_path = save_path[:-len(".jsonl")]
+        self.save_path = save_path + RECORDS_SUFFIX + COMPRESSION_SUFFIXES[compression]
+        os.makedirs(os.path.dirname(self.save_path) or ".", exist_ok=True)
+        if mode == "w":
+            for path in (self.save_path, save_path + ".texts.jsonl" + COMPRESSION_SUFFIXES[compression]):
+                if os.path.exists(path) and not (texts and path == texts.save_path):
+                    os.remove(path)
+        self.owns_texts = texts is None
+        self.texts = texts if texts is not None else TextStore(save_path + ".texts.jsonl", compression)
+        self.file = open_text(self.save_path, "a")
+        self.flush_every = 1 if compression is None else flush_every
+        self.pending = 0
+
+    def write(self, record):
+        record = dict(record)
+        original_text_id = self.texts.add(record.pop("original_text"))
+        record = {"original_text_id": original_text_id, **record}
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Texts first, so a flushed record never points at an unflushed text.
+        self.texts.flush()
+        flush_text(self.file, self.save_path)
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        if self.owns_texts:
+            self.texts.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def default_texts_path(records_path):
+    """
+    <name>.texts.jsonl[.zst] next to <name>.records.jsonl[.zst]. Runs sharing one TextStore (run_fanout.py) keep
+    their texts elsewhere and have to pass texts_path explicitly.
+    """
+    base, _, suffix = records_path.partition(RECORDS_SUFFIX)
+    return f"{base}.texts.jsonl{suffix}"
+
+
+def iter_results(records_path, texts_path=None, resolve=True):
+    """
+    Read records back; with resolve=True original_text is filled in from the texts file (loaded into memory).
+    """
+    if not resolve:
+        yield from iter_jsonl(records_path)
+        return
+    texts = {entry["id"]: entry["text"] for entry in iter_jsonl(texts_path or default_texts_path(records_path))}
+    for record in iter_jsonl(records_path):
+        yield {"original_text": texts[record.pop("original_text_id")], **record}
+
+
+def result_writer(save_path, mode="a", texts=None):
+    """
+    Writer for the scripts' output: a plain JsonlWriter by default, a ResultStore with RESULT_STORE=compact,
+    compressed with RESULT_COMPRESSION=zstd. texts optionally shares one TextStore between several writers.
+    """
+    if os.getenv("RESULT_STORE") == "compact":
+        return ResultStore(save_path, compression=os.getenv("RESULT_COMPRESSION") or None, texts=texts, mode=mode)
+    from data_io import JsonlWriter
+    return JsonlWriter(save_path, mode)
+
+
+def save_results(records, save_path, compression=None):
+    """
+    Overwrite save_path with records as a compact result store; the save_results of every transformer.
+    """
+    with ResultStore(save_path, compression=compression, mode="w") as store:
+        for record in records:
+            store.write(record)
+
+
+def write_results(records, save_path, mode="a", writer=None):
+    """
+    Consume a record iterator into writer (default result_writer(save_path, mode)). Returns the number written.
+    """
+    count = 0
+    with writer or result_writer(save_path, mode) as writer:
+        for record in records:
+            writer.write(record)
+            count += 1
+    return count
+
+
+def export_columnar(records_path, save_prefix, texts_path=None, format="parquet", batch_size=10000):
+    """
+    Write a compact result store as columnar files: <save_prefix>.<ext> with the records and
+    <save_prefix>.texts.<ext> with the source texts, where ext is "parquet" or "arrow" (Arrow IPC, memory-mappable).
+    Rows are converted batch_size at a time, so memory stays bounded.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Columnar export needs the pyarrow package: pip install pyarrow") from e
+    texts_path = texts_path or default_texts_path(records_path)
+
+    schemas = {
+        "records": pa.schema([("original_text_id", pa.string()), ("type", pa.string()), ("transformed_text", pa.string()), ("tag", pa.list_(pa.string()))]),
+        "texts": pa.schema([("id", pa.string()), ("text", pa.string())]),
+    }
+    outputs = {"records": (records_path, f"{save_prefix}.{format}"), "texts": (texts_path, f"{save_prefix}.texts.{format}")}
+    for name, (source, target) in outputs.items():
+        schema = schemas[name]
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        writer = pq.ParquetWriter(target, schema, compression="zstd") if format == "parquet" else pa.ipc.new_file(target, schema)
+        with writer:
+            rows = []
+            for row in iter_jsonl(source):
+                rows.append({field: row.get(field) for field in schema.names})
+                if len(rows) >= batch_size:
+                    writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+                    rows = []
+            if rows:
+                writer.write_batch(pa.RecordBatch.from_pylist(rows, schema=schema))
+    return {name: target for name, (_, target) in outputs.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export a compact result store as Parquet or Arrow IPC files.")
+    parser.add_argument("records_path", help="e.g. result/genre_transformation/summary.records.jsonl.zst")
+    parser.add_argument("--texts-path", default=None,
+                        help="defaults to <name>.texts.jsonl[.zst] next to the records; run_fanout.py output uses <save-dir>/corpus.texts.jsonl[.zst]")
+    parser.add_argument("--save-prefix", default=None, help="defaults to records_path without the .records.jsonl[.zst] suffix")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    args = parser.parse_args()
+
+    outputs = export_columnar(args.records_path, args.save_prefix or args.records_path.partition(RECORDS_SUFFIX)[0], texts_path=args.texts_path, format=args.format)
+    print("Wrote", ", ".join(outputs.values()))
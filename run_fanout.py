@@ -0,0 +1,140 @@
+"""
+Run several genre transformers over data/wikibooks.jsonl in one pass over the corpus.
+
+    python run_fanout.py narration summary --limit 100
+    python run_fanout.py narration overall_summary different_perspectives_summary --prefilter --dedup-threshold 0.8
+
+Every document is read, parsed, shuffled, prefiltered and deduplicated once, then handed to each transformer.
+Transformers run concurrently in their own threads, fed through bounded queues, so the reader only runs ahead
+of the slowest transformer by queue_size documents. Each transformer keeps its own checkpoint, output and metrics
+under --save-dir; with RESULT_STORE=compact all of them share one texts file, so every source text is stored once.
+That file is <save-dir>/corpus.texts.jsonl[.zst], so pass it when reading or exporting the records:
+
+    python result_store.py result/genre_transformation/narration.records.jsonl --texts-path result/genre_transformation/corpus.texts.jsonl
+"""
+import os
+import sys
+import queue
+import argparse
+import itertools
+import threading
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+from run_sharded import TRANSFORMERS, load_transformer
+
+_DONE = object()
+
+
+def shared_documents(file_path, shuffle_buffer_size=0, seed=None, prefilter=None, dedup=None, limit=None):
+    """
+    The preprocessing every transformer shares, done once per document: lazy read, optional shuffle,
+    local prefilter and near-duplicate removal.
+    """
+    from data_io import stream_documents, shuffle_buffer
+
+    dataset = stream_documents(file_path)
+    if shuffle_buffer_size:
+        dataset = shuffle_buffer(dataset, buffer_size=shuffle_buffer_size, seed=seed)
+    if prefilter:
+        dataset = (data for data in dataset if prefilter(data.page_content))
+    if dedup:
+        dataset = dedup.filter(dataset)
+    return itertools.islice(dataset, limit)
+
+
+class FanOut:
+    """
+    Feed one document stream to several consumers, each through its own bounded queue.
+    A consumer that fails keeps draining its queue, so it never blocks the others.
+    """
+    def __init__(self, consumers, queue_size=32):
+        self.consumers = consumers
+        self.queues = {name: queue.Queue(maxsize=queue_size) for name in consumers}
+        self.errors = {}
+
+    def _iter_queue(self, name):
+        while (data := self.queues[name].get()) is not _DONE:
+            yield data
+
+    def _run(self, name):
+        try:
+            self.consumers[name](self._iter_queue(name))
+        except Exception as e:
+            self.errors[name] = e
+            print(f"{name} failed: {e!r}", file=sys.stderr)
+            for _ in self._iter_queue(name):
+                pass
+
+    def run(self, dataset):
+        threads = [threading.Thread(target=self._run, args=(name,), name=name) for name in self.consumers]
+        for thread in threads:
+            thread.start()
+        for data in dataset:
+            for q in self.queues.values():
+                q.put(data)
+        for q in self.queues.values():
+            q.put(_DONE)
+        for thread in threads:
+            thread.join()
+        return self.errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("transformers", nargs="+", choices=sorted(TRANSFORMERS))
+    parser.add_argument("--input", default="./data/wikibooks.jsonl")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--shuffle-buffer", type=int, default=int(os.getenv("SHUFFLE_BUFFER", 10000)), help="0 keeps corpus order")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--prefilter", action="store_true", help="drop short and mostly non-English documents before any transformer")
+    parser.add_argument("--dedup-threshold", type=float, default=None, help="drop near-duplicates above this Jaccard similarity")
+    parser.add_argument("--dedup-max-documents", type=int, default=None, help="signatures kept for dedup (default 500000, 0 keeps all)")
+    parser.add_argument("--queue-size", type=int, default=32)
+    parser.add_argument("--save-dir", default="result/genre_transformation")
+    args = parser.parse_args()
+
+    from checkpoint import CheckpointStore
+    from prefilter import LocalPrefilter
+    from result_store import TextStore, result_writer
+
+    prefilter = LocalPrefilter() if args.prefilter else None
+    dedup = None
+    if args.dedup_threshold:
+        from dedup import MinHashDeduplicator, DEFAULT_MAX_DOCUMENTS
+        max_documents = DEFAULT_MAX_DOCUMENTS if args.dedup_max_documents is None else args.dedup_max_documents or None
+        dedup = MinHashDeduplicator(threshold=args.dedup_threshold, max_documents=max_documents)
+
+    transformers = {name: load_transformer(name) for name in dict.fromkeys(args.transformers)}
+
+    texts = None
+    if os.getenv("RESULT_STORE") == "compact":
+        compression = os.getenv("RESULT_COMPRESSION") or None
+        texts = TextStore(os.path.join(args.save_dir, "corpus.texts.jsonl"), compression)
+
+    counts = {}
+
+    def consumer(name, transformer):
+        def consume(dataset):
+            checkpoint = CheckpointStore(os.path.join(args.save_dir, "checkpoints", f"{name}.jsonl"), name, transformer.prompt_version)
+            with checkpoint, result_writer(os.path.join(args.save_dir, f"{name}.jsonl"), texts=texts) as writer:
+                for record in transformer.iter_transform(dataset, checkpoint):
+                    writer.write(record)
+                    counts[name] = counts.get(name, 0) + 1
+        return consume
+
+    dataset = shared_documents(args.input, args.shuffle_buffer, args.seed, prefilter, dedup, args.limit)
+    errors = FanOut({name: consumer(name, transformer) for name, transformer in transformers.items()}, args.queue_size).run(dataset)
+    if texts:
+        texts.close()
+
+    for name, transformer in transformers.items():
+        if hasattr(transformer, "metrics"):
+            transformer.metrics.export(os.path.join(args.save_dir, "metrics", name))
+        print(f"{name}: {counts.get(name, 0)} records" + (" (failed)" if name in errors else ""))
+    if dedup:
+        print("Dedup:", dedup.stats())
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
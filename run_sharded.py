@@ -0,0 +1,142 @@
+"""
+Run a genre transformer over data/wikibooks.jsonl split into deterministic byte-offset shards.
+
+    python run_sharded.py narration --num-shards 16 --workers 8
+    python run_sharded.py summary --num-shards 16 --shards 3,7     # e.g. on another machine
+    python run_sharded.py summary --num-shards 16 --merge-only
+
+Every shard writes its own JSONL output and checkpoint, so re-running a shard resumes it instead of
+duplicating records (--fresh starts it over). The merge step concatenates shard outputs in shard order
+into result/genre_transformation/<transformer>.jsonl, dropping records that appear twice.
+"""
+import os
+import sys
+import json
+import asyncio
+import hashlib
+import argparse
+import importlib
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+TRANSFORMERS = {
+    "narration": ("genre_transformation.narration.all", "NarrativeTransformer"),
+    "summary": ("genre_transformation.summary.all", "SummaryTransformer"),
+    "overall_summary": ("genre_transformation.summary.overall", "OverallSummaryTransformer"),
+    "different_perspectives_summary": ("genre_transformation.summary.different_perspective", "DifferentPerspectivesTransformer"),
+}
+
+
+def load_transformer(name):
+    module_name, class_name = TRANSFORMERS[name]
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def shard_name(index, num_shards):
+    return f"shard-{index:05d}-of-{num_shards:05d}"
+
+
+def run_shard(name, file_path, index, num_shards, shard_dir, limit=None, async_chunk=0, fresh=False):
+    from data_io import stream_documents, shard_offsets, JsonlWriter
+    from checkpoint import CheckpointStore
+
+    prefix = os.path.join(shard_dir, shard_name(index, num_shards))
+    if fresh:
+        for suffix in (".jsonl", ".checkpoint.jsonl"):
+            if os.path.exists(prefix + suffix):
+                os.remove(prefix + suffix)
+
+    start, end = shard_offsets(file_path, num_shards)[index]
+    dataset = itertools.islice(stream_documents(file_path, start=start, end=end), limit)
+    transformer = load_transformer(name)
+
+    written = 0
+    with CheckpointStore(f"{prefix}.checkpoint.jsonl", name, transformer.prompt_version) as checkpoint, JsonlWriter(f"{prefix}.jsonl") as writer:
+        if async_chunk and hasattr(transformer, "atransform_dataset"):
+            while True:
+                chunk = list(itertools.islice(dataset, async_chunk))
+                if not chunk:
+                    break
+                written += len(asyncio.run(transformer.atransform_dataset(chunk, checkpoint, writer)))
+        else:
+            for record in transformer.iter_transform(dataset, checkpoint):
+                writer.write(record)
+                written += 1
+
+    if hasattr(transformer, "metrics"):
+        transformer.metrics.export(f"{prefix}.metrics")
+    return index, written
+
+
+def record_key(record):
+    content = f"{record['type']}\0{record['original_text']}"
+    return hashlib.sha256(content.encode("utf-8")).digest()
+
+
+def merge_shards(num_shards, shard_dir, save_path):
+    """
+    Concatenate the shard outputs in shard order, keeping the first record per (type, original_text).
+    """
+    seen = set()
+    written = duplicates = 0
+    os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+    with open(save_path, "w", encoding="utf-8") as out:
+        for index in range(num_shards):
+            path = os.path.join(shard_dir, f"{shard_name(index, num_shards)}.jsonl")
+            if not os.path.exists(path):
+                print(f"Missing {path}, skipped", file=sys.stderr)
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from a crashed worker
+                    key = record_key(record)
+                    if key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    written += 1
+    return written, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("transformer", choices=sorted(TRANSFORMERS))
+    parser.add_argument("--input", default="./data/wikibooks.jsonl")
+    parser.add_argument("--num-shards", type=int, default=os.cpu_count())
+    parser.add_argument("--shards", default=None, help="comma-separated shard indices to run (default: all)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--limit", type=int, default=None, help="documents per shard, for testing")
+    parser.add_argument("--async-chunk", type=int, default=0, help="documents per async batch for transformers with atransform_dataset")
+    parser.add_argument("--fresh", action="store_true", help="discard existing output and checkpoint of the selected shards")
+    parser.add_argument("--merge-only", action="store_true")
+    parser.add_argument("--no-merge", action="store_true")
+    parser.add_argument("--save-dir", default="result/genre_transformation")
+    args = parser.parse_args()
+
+    shard_dir = os.path.join(args.save_dir, "shards", args.transformer)
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = [int(i) for i in args.shards.split(",")] if args.shards else list(range(args.num_shards))
+
+    if not args.merge_only:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+            futures = [pool.submit(run_shard, args.transformer, args.input, index, args.num_shards, shard_dir, args.limit, args.async_chunk, args.fresh) for index in shards]
+            for future in as_completed(futures):
+                index, written = future.result()
+                print(f"{shard_name(index, args.num_shards)}: {written} records")
+
+    if not args.no_merge:
+        save_path = os.path.join(args.save_dir, f"{args.transformer}.jsonl")
+        written, duplicates = merge_shards(args.num_shards, shard_dir, save_path)
+        print(f"Merged {written} records into {save_path} ({duplicates} duplicates dropped)")
+
+
+if __name__ == "__main__":
+    main()